@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+import os
+import time
+import boto3
+import typing
+import pathlib
+import threading
+
+from botocore import config
+from concurrent import futures
+
+# AWS_DEFAULT_REGION
+# AWS_PROFILE
+# AWS_ACCESS_KEY_ID
+# AWS_SECRET_ACCESS_KEY
+
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+CHUNK_SIZE = 1024 * 1024
+
+
+def list_objects(client: any, bucket: str, prefix: str = "", delimiter: str = "", limit: int = 0) -> typing.Iterator:
+    kwargs = {"Bucket": bucket, "Prefix": prefix}
+    if delimiter:
+        kwargs["Delimiter"] = delimiter
+
+    while True:
+        if limit > 0:
+            kwargs["MaxKeys"] = min(limit, 1000)
+
+        response = client.list_objects_v2(**kwargs)
+        page = response.get("CommonPrefixes", []) + response.get("Contents", [])
+
+        for item in page[:limit] if limit > 0 else page:
+            yield item
+
+        if limit > 0:
+            limit -= len(page)
+            if limit <= 0:
+                return
+
+        if not response.get("IsTruncated"):
+            return
+
+        kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+
+def get_object_data(client: any, bucket: str, file: str) -> bytes:
+    response = client.get_object(Bucket=bucket, Key=file)
+    return response["Body"].read()
+
+
+def stream_object(client: any, bucket: str, file: str, out: typing.BinaryIO, byte_range: str = "") -> int:
+    kwargs = {"Bucket": bucket, "Key": file}
+    if byte_range:
+        kwargs["Range"] = "bytes={}".format(byte_range)
+
+    response = client.get_object(**kwargs)
+    size = 0
+
+    for chunk in response["Body"].iter_chunks(CHUNK_SIZE):
+        out.write(chunk)
+        size += len(chunk)
+
+    out.flush()
+    return size
+
+
+def put_object_data(client: any, bucket: str, file: str, data: typing.Union[bytes, typing.BinaryIO]) -> dict:
+    return client.put_object(Bucket=bucket, Key=file, Body=data)
+
+
+def get_part_size(size: int, part_size: int) -> int:
+    # S3 allows up to 10000 parts and at least 5 MiB per part.
+    part_size = max(part_size, MIN_PART_SIZE)
+    while size > part_size * MAX_PARTS:
+        part_size *= 2
+
+    return part_size
+
+
+def get_object_range(client: any, bucket: str, file: str, fd: int, start: int, end: int, etag: str = "") -> int:
+    options = {"IfMatch": etag} if etag else {}
+    response = client.get_object(Bucket=bucket, Key=file, Range="bytes={}-{}".format(start, end), **options)
+    offset = start
+
+    for chunk in response["Body"].iter_chunks(CHUNK_SIZE):
+        os.pwrite(fd, chunk, offset)
+        offset += len(chunk)
+
+    return offset - start
+
+
+def download_object(client: any, bucket: str, file: str, file_name: str, part_size: int, workers: int) -> None:
+    # Every part is pinned to the same ETag, an object replaced mid-download fails with 412.
+    head = client.head_object(Bucket=bucket, Key=file)
+    (size, etag) = (head["ContentLength"], head["ETag"])
+    part_size = get_part_size(size, part_size)
+
+    file_path = pathlib.Path(file_name)
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+
+    with file_path.open("wb") as fd:
+        fd.truncate(size)
+
+        with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            jobs = [
+                pool.submit(get_object_range, client, bucket, file, fd.fileno(), start, min(start + part_size, size) - 1, etag)
+                for start in range(0, size, part_size)
+            ]
+
+            for job in futures.as_completed(jobs):
+                job.result()
+
+
+def upload_part(client: any, bucket: str, file: str, upload_id: str, fd: int, number: int, start: int, size: int) -> dict:
+    response = client.upload_part(
+        Bucket=bucket, Key=file, UploadId=upload_id,
+        PartNumber=number, Body=os.pread(fd, size, start)
+    )
+
+    return {"PartNumber": number, "ETag": response["ETag"]}
+
+
+def upload_object(client: any, bucket: str, file: str, file_name: str, part_size: int, workers: int) -> dict:
+    file_path = pathlib.Path(file_name)
+    size = file_path.stat().st_size
+    part_size = get_part_size(size, part_size)
+
+    with file_path.open("rb") as fd:
+        if size <= part_size:
+            return put_object_data(client, bucket, file, fd)
+
+        upload_id = client.create_multipart_upload(Bucket=bucket, Key=file)["UploadId"]
+
+        try:
+            with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                jobs = [
+                    pool.submit(upload_part, client, bucket, file, upload_id, fd.fileno(), number, start, min(part_size, size - start))
+                    for (number, start) in enumerate(range(0, size, part_size), 1)
+                ]
+
+                parts = [job.result() for job in jobs]
+
+            return client.complete_multipart_upload(
+                Bucket=bucket, Key=file, UploadId=upload_id,
+                MultipartUpload={"Parts": parts}
+            )
+
+        except BaseException:
+            client.abort_multipart_upload(Bucket=bucket, Key=file, UploadId=upload_id)
+            raise
+
+
+class ClientStats:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.retry_time = 0.0
+
+    def __str__(self) -> str:
+        return "Requests: {} Retries: {} Sent: {} Received: {} Retry time: {:.3f}s".format(
+            self.requests, self.retries, self.bytes_sent, self.bytes_received, self.retry_time
+        )
+
+    def register(self, client: any) -> None:
+        client.meta.events.register("before-call", self._before_call)
+        client.meta.events.register("before-send", self._before_send)
+        client.meta.events.register("after-call", self._after_call)
+
+    def _before_call(self, context: dict, **kwargs) -> None:
+        context["stats_start"] = time.monotonic()
+
+    def _before_send(self, request: any, **kwargs) -> None:
+        # Streamed bodies (files, aws-chunked uploads) are sized from the headers.
+        body = request.body
+        size = len(body) if isinstance(body, (bytes, bytearray)) else int(
+            request.headers.get("Content-Length") or request.headers.get("X-Amz-Decoded-Content-Length") or 0
+        )
+
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += size
+
+    def _after_call(self, http_response: any, parsed: dict, context: dict, **kwargs) -> None:
+        attempts = parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+        size = int(http_response.headers.get("content-length", 0) or 0)
+
+        with self._lock:
+            self.bytes_received += size
+
+            if attempts:
+                self.retries += attempts
+                self.retry_time += time.monotonic() - context.get("stats_start", time.monotonic())
+
+
+def get_client(service: str = "s3", pool_size: int = 10, stats: ClientStats = None) -> any:
+    client = boto3.client(service, config=config.Config(
+        max_pool_connections=max(pool_size, 10),
+        retries={"mode": "adaptive", "max_attempts": 10},
+        tcp_keepalive=True,
+        connect_timeout=10,
+        read_timeout=60
+    ))
+
+    if stats:
+        stats.register(client)
+
+    return client
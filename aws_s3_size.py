@@ -1,32 +1,34 @@
 #!/usr/bin/env python3
 import sys
-import boto3
+import json
+import pathlib
+import argparse
 import datetime
 import traceback
+import aws_s3_client
+
+from concurrent import futures
 
 # AWS_DEFAULT_REGION
 # AWS_PROFILE
 # AWS_ACCESS_KEY_ID
 # AWS_SECRET_ACCESS_KEY
 
+MAX_QUERIES = 500
 
-try:
-    now = datetime.datetime.now()
-    start_time = now - datetime.timedelta(days=3)
-    bucket = sys.argv[1]
-    client = boto3.client("cloudwatch")
 
+def get_bucket_size(client: any, bucket: str, start_time: datetime.datetime, end_time: datetime.datetime) -> None:
     responce = client.get_metric_statistics(
         Namespace="AWS/S3",
         MetricName="BucketSizeBytes",
         Statistics=["Average"],
         Dimensions=[
-            {"Name": "BucketName",  "Value": bucket},
+            {"Name": "BucketName", "Value": bucket},
             {"Name": "StorageType", "Value": "StandardStorage"}
         ],
         Period=3600,
         StartTime=start_time.isoformat(),
-        EndTime=now.isoformat()
+        EndTime=end_time.isoformat()
     )
 
     for item in responce["Datapoints"]:
@@ -39,6 +41,181 @@ try:
             (size / 1024 / 1024 / 1024)
         ))
 
+
+def list_metrics(client: any, buckets: set) -> list:
+    metrics = list()
+    paginator = client.get_paginator("list_metrics")
+
+    for name in ["BucketSizeBytes", "NumberOfObjects"]:
+        for page in paginator.paginate(Namespace="AWS/S3", MetricName=name):
+            for item in page["Metrics"]:
+                dims = {dim["Name"]: dim["Value"] for dim in item["Dimensions"]}
+
+                if not buckets or dims.get("BucketName") in buckets:
+                    metrics.append(item)
+
+    return metrics
+
+
+def get_metric_data(client: any, metrics: list, start_time: datetime.datetime, end_time: datetime.datetime) -> dict:
+    # Returns {(bucket, metric, storage_type): latest_value}
+    result = dict()
+
+    for offset in range(0, len(metrics), MAX_QUERIES):
+        batch = metrics[offset:offset + MAX_QUERIES]
+        queries = [
+            {
+                "Id": "m{}".format(index),
+                "MetricStat": {"Metric": item, "Period": 86400, "Stat": "Average"},
+                "ReturnData": True
+            }
+            for (index, item) in enumerate(batch)
+        ]
+
+        paginator = client.get_paginator("get_metric_data")
+        for page in paginator.paginate(MetricDataQueries=queries, StartTime=start_time, EndTime=end_time, ScanBy="TimestampDescending"):
+            for item in page["MetricDataResults"]:
+                if not item["Values"]:
+                    continue
+
+                metric = batch[int(item["Id"][1:])]
+                dims = {dim["Name"]: dim["Value"] for dim in metric["Dimensions"]}
+                key = (dims["BucketName"], metric["MetricName"], dims["StorageType"])
+                result.setdefault(key, item["Values"][0])
+
+    return result
+
+
+def aggregate(data: dict) -> list:
+    buckets = dict()
+
+    for ((bucket, metric, storage), value) in data.items():
+        item = buckets.setdefault(bucket, {"bucket": bucket, "size": 0, "objects": 0, "storage": dict()})
+
+        if metric == "NumberOfObjects":
+            item["objects"] += int(value)
+
+        else:
+            item["size"] += int(value)
+            item["storage"][storage] = int(value)
+
+    return sorted(buckets.values(), key=lambda item: item["size"], reverse=True)
+
+
+def list_partitions(client: any, bucket: str, prefix: str) -> tuple:
+    # Root level objects are only summed, a flat bucket must not be kept in memory.
+    partitions = list()
+    (size, count) = (0, 0)
+
+    for item in aws_s3_client.list_objects(client, bucket, prefix, "/"):
+        if "Prefix" in item:
+            partitions.append(item["Prefix"])
+
+        else:
+            size += item["Size"]
+            count += 1
+
+    return (partitions, size, count)
+
+
+def add_object(tree: dict, prefix: str, key: str, size: int, depth: int) -> None:
+    parts = key[len(prefix):].split("/")[:-1]
+    path = prefix
+
+    node = tree.setdefault(path, [0, 0])
+    node[0] += size
+    node[1] += 1
+
+    for part in parts[:depth]:
+        path += part + "/"
+        node = tree.setdefault(path, [0, 0])
+        node[0] += size
+        node[1] += 1
+
+
+def scan_partition(client: any, bucket: str, prefix: str, partition: str, depth: int) -> dict:
+    tree = dict()
+
+    for item in aws_s3_client.list_objects(client, bucket, partition):
+        add_object(tree, prefix, item["Key"], item["Size"], depth)
+
+    return tree
+
+
+def get_prefix_usage(client: any, bucket: str, prefix: str, depth: int, workers: int) -> dict:
+    (partitions, size, count) = list_partitions(client, bucket, prefix)
+    tree = {prefix: [size, count]}
+
+    with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        jobs = [pool.submit(scan_partition, client, bucket, prefix, partition, depth) for partition in partitions]
+
+        for job in futures.as_completed(jobs):
+            for (path, (size, count)) in job.result().items():
+                node = tree.setdefault(path, [0, 0])
+                node[0] += size
+                node[1] += count
+
+    return tree
+
+
+def print_usage(bucket: str, tree: dict, top: int) -> None:
+    items = sorted(tree.items(), key=lambda item: item[1][0], reverse=True)
+
+    for (path, (size, count)) in items[:top] if top > 0 else items:
+        print("{:>12.3f} GiB {:>12} s3://{}/{}".format(size / 1024 / 1024 / 1024, count, bucket, path))
+
+
+def print_table(items: list) -> None:
+    for item in items:
+        print("{:>12.3f} GiB {:>12} s3://{}/".format(item["size"] / 1024 / 1024 / 1024, item["objects"], item["bucket"]))
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("buckets", nargs="*", help="Set bucket names.")
+    parser.add_argument("--all", dest="all", action="store_true", help="Report all buckets and storage types.")
+    parser.add_argument("--file", dest="file", default="", help="Read bucket names from a file.")
+    parser.add_argument("--json", dest="json", action="store_true", help="Print report as JSON.")
+    parser.add_argument("--du", dest="du", action="store_true", help="Report prefix usage by listing objects.")
+    parser.add_argument("--prefix", dest="prefix", default="", help="Set root prefix for --du.")
+    parser.add_argument("--depth", dest="depth", default="2", type=int, help="Set prefix depth for --du.")
+    parser.add_argument("--top", dest="top", default="20", type=int, help="Set prefix output limit for --du (0 - unlimited).")
+    parser.add_argument("--workers", dest="workers", default="16", type=int, help="Set listing concurrency for --du.")
+    return parser.parse_args()
+
+
+try:
+    args = parse_args()
+    now = datetime.datetime.now()
+    start_time = now - datetime.timedelta(days=3)
+
+    buckets = set(args.buckets)
+    if args.file:
+        buckets.update(filter(None, pathlib.Path(args.file).read_text().split()))
+
+    if args.du:
+        client = aws_s3_client.get_client("s3", args.workers)
+
+        for bucket in sorted(buckets):
+            print_usage(bucket, get_prefix_usage(client, bucket, args.prefix, args.depth, args.workers), args.top)
+
+    elif len(buckets) == 1 and not (args.all or args.file or args.json):
+        client = aws_s3_client.get_client("cloudwatch")
+        get_bucket_size(client, buckets.pop(), start_time, now)
+
+    elif buckets or args.all:
+        client = aws_s3_client.get_client("cloudwatch")
+        items = aggregate(get_metric_data(client, list_metrics(client, buckets), start_time, now))
+
+        if args.json:
+            print(json.dumps(items, indent=2))
+
+        else:
+            print_table(items)
+
+    else:
+        raise ValueError("Set bucket names or --all!")
+
 except Exception:
     traceback.print_exc()
     sys.exit(1)
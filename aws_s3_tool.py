@@ -1,93 +1,301 @@
 #!/usr/bin/env python3
+import os
+import re
 import sys
-import boto3
+import typing
+import sqlite3
+import fnmatch
 import pathlib
 import argparse
+import itertools
 import traceback
+import aws_s3_client
+
+from concurrent import futures
 
 # AWS_DEFAULT_REGION
 # AWS_PROFILE
 # AWS_ACCESS_KEY_ID
 # AWS_SECRET_ACCESS_KEY
 
+DELETE_BATCH = 1000
 
-def list_objects(client: any, bucket: str, prefix: str = "", items: int = 200) -> list:
-    response = client.list_objects_v2(Bucket=bucket, Prefix=prefix, MaxKeys=items)
-    return (response["IsTruncated"], response["Contents"])
 
+def delete_object(client: any, bucket: str, file: str) -> None:
+    client.delete_object(Bucket=bucket, Key=file)
 
-def get_object_data(client: any, bucket: str, file: str) -> bytes:
-    response = client.get_object(Bucket=bucket, Key=file)
-    return response["Body"].read()
 
+def delete_batch(client: any, bucket: str, items: list) -> tuple:
+    response = client.delete_objects(
+        Bucket=bucket, Delete={"Objects": [{"Key": item["Key"]} for item in items], "Quiet": True}
+    )
 
-def put_object_data(client: any, bucket: str, file: str, data: bytes) -> dict:
-    return client.put_object(Bucket=bucket, Key=file, Body=data)
+    errors = response.get("Errors", [])
+    failed = set(item["Key"] for item in errors)
+    size = sum(item["Size"] for item in items if item["Key"] not in failed)
+    return (len(items) - len(failed), size, errors)
 
 
-def delete_object(client: any, bucket: str, file: str) -> None:
-    client.delete_object(Bucket=bucket, Key=file)
+def list_matching(client: any, bucket: str, prefix: str, pattern: str) -> typing.Iterator:
+    if pattern:
+        # Only the literal head of the pattern can narrow the listing.
+        head = re.split(r"[*?\[]", pattern, maxsplit=1)[0]
+        prefix = head if head.startswith(prefix) else prefix
+
+    for item in aws_s3_client.list_objects(client, bucket, prefix):
+        if not pattern or fnmatch.fnmatchcase(item["Key"], pattern):
+            yield item
+
+
+def delete_objects(client: any, bucket: str, items: typing.Iterable, workers: int, dry_run: bool = False) -> tuple:
+    (count, size, pending) = (0, 0, set())
+    batches = iter(lambda: list(itertools.islice(items, DELETE_BATCH)), [])
+
+    def collect(jobs: set) -> None:
+        nonlocal count, size
+        for job in jobs:
+            (deleted, deleted_size, errors) = job.result()
+            count += deleted
+            size += deleted_size
+
+            for error in errors:
+                print("Error: {} {} {}".format(error["Key"], error.get("Code"), error.get("Message")), file=sys.stderr)
+
+    if dry_run:
+        for batch in batches:
+            count += len(batch)
+            size += sum(item["Size"] for item in batch)
+
+        return (count, size)
+
+    with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for batch in batches:
+            if len(pending) >= workers * 2:
+                (done, pending) = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                collect(done)
+
+            pending.add(pool.submit(delete_batch, client, bucket, batch))
+
+        collect(futures.wait(pending).done)
+
+    return (count, size)
+
+
+class SyncManifest:
+    def __init__(self, file_name: str) -> None:
+        file_path = pathlib.Path(file_name).expanduser()
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._db = sqlite3.connect(str(file_path))
+        # Keyed by local path too, one prefix synced with several directories keeps separate states.
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "bucket TEXT, key TEXT, path TEXT, size INTEGER, mtime INTEGER, etag TEXT, "
+            "PRIMARY KEY (bucket, key, path))"
+        )
+
+    def __enter__(self) -> "SyncManifest":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._db.commit()
+        self._db.close()
+
+    def get(self, bucket: str, key: str, path: str) -> tuple:
+        cursor = self._db.execute(
+            "SELECT path, size, mtime, etag FROM files WHERE bucket = ? AND key = ? AND path = ?",
+            (bucket, key, os.path.abspath(path))
+        )
+
+        return cursor.fetchone()
+
+    def put(self, bucket: str, key: str, path: str, stat: os.stat_result, etag: str) -> None:
+        self._db.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+            (bucket, key, os.path.abspath(path), stat.st_size, stat.st_mtime_ns, etag)
+        )
+
+
+def list_local_files(base_dir: str) -> typing.Iterator:
+    for (root, _, files) in os.walk(base_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            yield (pathlib.PurePath(os.path.relpath(path, base_dir)).as_posix(), path, os.stat(path))
+
+
+def run_transfers(jobs: list, func: typing.Callable, part_size: int, workers: int) -> typing.Iterator:
+    # Small files are transferred concurrently, large ones one by one with parallel parts.
+    small = [job for job in jobs if job[-1] <= part_size]
+    large = [job for job in jobs if job[-1] > part_size]
+
+    with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        tasks = {pool.submit(func, *job[:-1], part_size, 1): job for job in small}
+
+        for task in futures.as_completed(tasks):
+            yield (tasks[task], task.result())
+
+    for job in large:
+        yield (job, func(*job[:-1], part_size, workers))
 
 
-def get_file_data(file_name: str) -> bytes:
-    file = pathlib.Path(file_name)
-    return file.read_bytes()
+def sync_upload(client: any, manifest: SyncManifest, bucket: str, prefix: str, base_dir: str, part_size: int, workers: int, trust: bool = False) -> int:
+    remote = dict()
+    if not trust:
+        remote = {item["Key"]: item["ETag"] for item in aws_s3_client.list_objects(client, bucket, prefix)}
 
+    jobs = list()
+    for (name, path, stat) in list_local_files(base_dir):
+        key = prefix + name
+        state = manifest.get(bucket, key, path)
 
-def put_file_data(file_name: str, data: bytes) -> None:
-    file = pathlib.Path(file_name)
-    file.parent.mkdir(parents=True, exist_ok=True)
-    file.touch(exist_ok=True)
-    file.write_bytes(data)
+        if state and state[1:3] == (stat.st_size, stat.st_mtime_ns) and (trust or remote.get(key) == state[3]):
+            continue
 
+        jobs.append((client, bucket, key, path, stat.st_size))
 
-def print_objects(items: list) -> None:
-    for item in items:
-        print("{} {} {}".format(item["Key"], item["Size"], item["LastModified"]))
+    for (job, response) in run_transfers(jobs, aws_s3_client.upload_object, part_size, workers):
+        print("put {}/{}".format(bucket, job[2]))
+        manifest.put(bucket, job[2], job[3], os.stat(job[3]), response["ETag"])
+
+    return len(jobs)
+
+
+def get_local_path(base_dir: str, name: str) -> str:
+    # Keys are untrusted: '/a' or '../a' must not escape the target directory.
+    base = os.path.realpath(base_dir)
+    path = os.path.realpath(os.path.join(base, name.lstrip("/")))
+
+    if os.path.commonpath([base, path]) != base or path == base:
+        return ""
+
+    return path
+
+
+def sync_download(client: any, manifest: SyncManifest, bucket: str, prefix: str, base_dir: str, part_size: int, workers: int) -> int:
+    jobs = list()
+    etags = dict()
+
+    for item in aws_s3_client.list_objects(client, bucket, prefix):
+        if item["Key"].endswith("/"):
+            continue
+
+        path = get_local_path(base_dir, item["Key"][len(prefix):])
+        if not path:
+            print("skip {}/{}: outside of {}".format(bucket, item["Key"], base_dir), file=sys.stderr)
+            continue
+
+        state = manifest.get(bucket, item["Key"], path)
+
+        if state and state[1] == item["Size"] and state[3] == item["ETag"]:
+            try:
+                if os.stat(path).st_mtime_ns == state[2]:
+                    continue
+
+            except FileNotFoundError:
+                pass
+
+        etags[item["Key"]] = item["ETag"]
+        jobs.append((client, bucket, item["Key"], path, item["Size"]))
+
+    for (job, _) in run_transfers(jobs, aws_s3_client.download_object, part_size, workers):
+        print("get {}/{}".format(bucket, job[2]))
+        manifest.put(bucket, job[2], job[3], os.stat(job[3]), etags[job[2]])
+
+    return len(jobs)
+
+
+def print_objects(items: typing.Iterable) -> None:
+    # Flushed once per listing page (1000 keys), not per key.
+    for (number, item) in enumerate(items, 1):
+        if "Prefix" in item:
+            print("{} PRE".format(item["Prefix"]))
+
+        else:
+            print("{} {} {}".format(item["Key"], item["Size"], item["LastModified"]))
+
+        if not number % 1000:
+            sys.stdout.flush()
 
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
-    parser.add_argument("cmd", choices=["ls", "get", "put", "rm", "cat"], help="Set action.")
+    parser.add_argument("cmd", choices=["ls", "get", "put", "rm", "cat", "sync"], help="Set action.")
     parser.add_argument("src", help="Set source file path or bucket name.")
-    parser.add_argument("dst", help="Set destination file path or bucket name.")
-    parser.add_argument("--limit", dest="limit", default="100", type=int, help="Set items output limit.")
+    parser.add_argument("dst", nargs="?", default="", help="Set destination file path or bucket name.")
+    parser.add_argument("--limit", dest="limit", default="100", type=int, help="Set items output limit (0 - unlimited).")
+    parser.add_argument("--delimiter", dest="delimiter", default="", help="Set keys grouping delimiter, e.g. / (default: recursive listing).")
+    parser.add_argument("--part-size", dest="part_size", default="8", type=int, help="Set transfer part size in MiB.")
+    parser.add_argument("--workers", dest="workers", default="8", type=int, help="Set transfer concurrency.")
+    parser.add_argument("--range", dest="range", default="", help="Set cat byte range, e.g. 0-1023 or -1024.")
+    parser.add_argument("--stats", dest="stats", action="store_true", help="Print API request statistics.")
+    parser.add_argument("--recursive", dest="recursive", action="store_true", help="List all keys without grouping.")
+    parser.add_argument("--prefix", dest="prefix", default="", help="Set keys prefix for sync and bulk rm.")
+    parser.add_argument("--glob", dest="glob", default="", help="Set keys pattern for bulk rm.")
+    parser.add_argument("--dry-run", dest="dry_run", action="store_true", help="Only count objects matched by bulk rm.")
+    parser.add_argument("--download", dest="download", action="store_true", help="Sync from bucket to local directory.")
+    parser.add_argument("--manifest", dest="manifest", default="~/.cache/aws_s3_tool/manifest.db", help="Set sync manifest file.")
+    parser.add_argument("--trust-manifest", dest="trust", action="store_true", help="Skip remote listing on upload.")
     return parser.parse_args()
 
 
 try:
     args = parse_args()
-    client = boto3.client("s3")
+    stats = aws_s3_client.ClientStats()
+    client = aws_s3_client.get_client("s3", args.workers * 2, stats)
 
     if args.cmd == "ls":
-        # Args: <bucket> <path> [--limit]
-        (truncated, items) = list_objects(client, args.src, args.dst, args.limit)
-        if truncated:
-            print("Warning! The list of files is truncated!", file=sys.stderr)
-
+        # Args: <bucket> <path> [--limit] [--delimiter] [--recursive]
+        delimiter = "" if args.recursive else args.delimiter
         print("Resource: arn:aws:s3:::{}".format(args.src))
-        print_objects(items)
+        print_objects(aws_s3_client.list_objects(client, args.src, args.dst, delimiter, args.limit))
 
     elif args.cmd == "get":
         # Args: <bucket> <file>
         print("{} {}/{}".format(args.cmd, args.src, args.dst))
-        put_file_data(args.dst, get_object_data(client, args.src, args.dst))
+        aws_s3_client.download_object(client, args.src, args.dst, args.dst, args.part_size * 1024 * 1024, args.workers)
 
     elif args.cmd == "put":
         # Args: <bucket> <file>
         print("{} {}/{}".format(args.cmd, args.src, args.dst))
-        put_object_data(client, args.src, args.dst, get_file_data(args.dst))
+        aws_s3_client.upload_object(client, args.src, args.dst, args.dst, args.part_size * 1024 * 1024, args.workers)
 
     elif args.cmd == "cat":
-        # Args: <bucket> <file>
-        print("{} {}/{}".format(args.cmd, args.src, args.dst))
-        print(get_object_data(client, args.src, args.dst))
+        # Args: <bucket> <file> [--range]
+        print("{} {}/{}".format(args.cmd, args.src, args.dst), file=sys.stderr)
+        aws_s3_client.stream_object(client, args.src, args.dst, sys.stdout.buffer, args.range)
+
+    elif args.cmd == "sync":
+        # Args: <bucket> <dir> [--prefix] [--download] [--manifest] [--trust-manifest]
+        part_size = args.part_size * 1024 * 1024
 
-    if args.cmd == "rm":
+        with SyncManifest(args.manifest) as manifest:
+            if args.download:
+                count = sync_download(client, manifest, args.src, args.prefix, args.dst, part_size, args.workers)
+
+            else:
+                count = sync_upload(client, manifest, args.src, args.prefix, args.dst, part_size, args.workers, args.trust)
+
+        print("Transferred: {}".format(count))
+
+    if args.cmd == "rm" and (args.prefix or args.glob):
+        # Args: <bucket> [--prefix] [--glob] [--dry-run]
+        items = list_matching(client, args.src, args.prefix, args.glob)
+        (count, size) = delete_objects(client, args.src, items, args.workers, args.dry_run)
+        print("{}: {} objects, {} bytes".format("Matched" if args.dry_run else "Deleted", count, size))
+
+    elif args.cmd == "rm":
         # Args: <bucket> <file>
         print("{} {}/{}".format(args.cmd, args.src, args.dst))
         delete_object(client, args.src, args.dst)
 
+    if args.stats:
+        print(stats, file=sys.stderr)
+
+except BrokenPipeError:
+    # The reader (e.g. head) went away, the pending output is dropped quietly.
+    os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    sys.exit(1)
+
 except Exception:
     traceback.print_exc()
     sys.exit(1)
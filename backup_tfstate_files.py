@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 import os
 import sys
-import boto3
+import json
 import pathlib
 import traceback
+import aws_s3_client
+import tfstate_store
+
+from concurrent import futures
 
 # AWS_DEFAULT_REGION
 # AWS_PROFILE
@@ -12,16 +16,9 @@ import traceback
 # CDKTF_BUCKET_NAME
 # CDKTF_BUCKET_ROOT
 # CDKTF_FORCE_WRITE
-
-
-def list_objects(client: any, bucket: str, prefix: str = "", items: int = 200) -> list:
-    response = client.list_objects_v2(Bucket=bucket, Prefix=prefix, MaxKeys=items)
-    return (response["IsTruncated"], response["Contents"])
-
-
-def get_object_data(client: any, bucket: str, file: str) -> bytes:
-    response = client.get_object(Bucket=bucket, Key=file)
-    return response["Body"].read()
+# CDKTF_INDEX_FILE
+# CDKTF_STORE_DIR
+# CDKTF_WORKERS
 
 
 def put_file_data(file_name: str, data: bytes, force: bool = False) -> None:
@@ -31,26 +28,115 @@ def put_file_data(file_name: str, data: bytes, force: bool = False) -> None:
     file.write_bytes(data)
 
 
+def load_index(file_name: str) -> dict:
+    file = pathlib.Path(file_name)
+    return json.loads(file.read_text()) if file.exists() else dict()
+
+
+def save_index(file_name: str, index: dict) -> None:
+    file = pathlib.Path(file_name)
+    tmp = file.with_name(file.name + ".tmp")
+    tmp.write_text(json.dumps(index, indent=2, sort_keys=True))
+    tmp.replace(file)
+
+
+def get_item_state(item: dict) -> dict:
+    return {"ETag": item["ETag"], "LastModified": item["LastModified"].isoformat()}
+
+
+def is_unchanged(index: dict, item: dict, store: any = None) -> bool:
+    exists = store.find(item["Key"]) if store else os.path.exists(item["Key"])
+    return index.get(item["Key"]) == get_item_state(item) and bool(exists)
+
+
+def backup_item(client: any, bucket: str, item: dict, force: bool) -> tuple:
+    data = aws_s3_client.get_object_data(client, bucket, item["Key"])
+    put_file_data(item["Key"], data, force)
+    return (item, "")
+
+
+def store_item(client: any, bucket: str, item: dict, store: any) -> tuple:
+    data = aws_s3_client.get_object_data(client, bucket, item["Key"])
+    return (item, store.put_blob(data))
+
+
 try:
     CDKTF_BUCKET_NAME = os.environ.get("CDKTF_BUCKET_NAME", "")
     CDKTF_BUCKET_ROOT = os.environ.get("CDKTF_BUCKET_ROOT", "")
     CDKTF_FORCE_WRITE = bool(os.environ.get("CDKTF_FORCE_WRITE", ""))
+    CDKTF_INDEX_FILE = os.environ.get("CDKTF_INDEX_FILE", ".tfstate_index.json")
+    CDKTF_STORE_DIR = os.environ.get("CDKTF_STORE_DIR", "")
+    CDKTF_WORKERS = int(os.environ.get("CDKTF_WORKERS", "16"))
 
-    client = boto3.client("s3")
+    stats = aws_s3_client.ClientStats()
+    client = aws_s3_client.get_client("s3", CDKTF_WORKERS, stats)
+    index = load_index(CDKTF_INDEX_FILE)
+    store = tfstate_store.SnapshotStore(CDKTF_STORE_DIR) if CDKTF_STORE_DIR else None
 
     print("Get files from {}.".format(CDKTF_BUCKET_NAME))
-    (truncated, files) = list_objects(client, CDKTF_BUCKET_NAME, CDKTF_BUCKET_ROOT)
-    if truncated:
-        print("Warning! The list of files is truncated!")
-
-    for item in filter(lambda item: item["Key"].endswith("tfstate"), files):
-        try:
-            print("Store {} to FS.".format(item["Key"]))
-            data = get_object_data(client, CDKTF_BUCKET_NAME, item["Key"])
-            put_file_data(item["Key"], data, CDKTF_FORCE_WRITE)
-
-        except FileExistsError as msg:
-            print(msg, file=sys.stderr)
+    states = list(filter(lambda item: item["Key"].endswith("tfstate"), aws_s3_client.list_objects(client, CDKTF_BUCKET_NAME, CDKTF_BUCKET_ROOT)))
+    files = list(filter(lambda item: CDKTF_FORCE_WRITE or not is_unchanged(index, item, store), states))
+
+    (failed, complete, done) = (0, True, False)
+
+    try:
+        if store:
+            snapshot = store.create_snapshot()
+            changed = set(item["Key"] for item in files)
+            for item in filter(lambda item: item["Key"] not in changed, states):
+                store.carry_entry(snapshot, item["Key"])
+
+        with futures.ThreadPoolExecutor(max_workers=CDKTF_WORKERS) as pool:
+            if store:
+                jobs = {pool.submit(store_item, client, CDKTF_BUCKET_NAME, item, store): item for item in files}
+
+            else:
+                # Files changed since the previous run are overwritten.
+                jobs = {pool.submit(backup_item, client, CDKTF_BUCKET_NAME, item, CDKTF_FORCE_WRITE or item["Key"] in index): item for item in files}
+
+            for job in futures.as_completed(jobs):
+                try:
+                    (item, digest) = job.result()
+                    index[item["Key"]] = get_item_state(item)
+
+                    if store:
+                        store.add_entry(snapshot, item["Key"], digest)
+                        print("Store {} to snapshot {}.".format(item["Key"], snapshot))
+
+                    else:
+                        print("Store {} to FS.".format(item["Key"]))
+
+                except FileExistsError as msg:
+                    print(msg, file=sys.stderr)
+
+                except Exception as error:
+                    # The snapshot keeps the previous state of a failed key,
+                    # a key without one would look like a deleted stack.
+                    failed += 1
+                    print("Failure {}: {}".format(jobs[job]["Key"], error), file=sys.stderr)
+
+                    if store and not store.carry_entry(snapshot, jobs[job]["Key"]):
+                        complete = False
+
+        done = True
+
+    finally:
+        if store and not (done and complete):
+            # The index must not point at states of a discarded snapshot.
+            store.rollback()
+            print("Snapshot is incomplete, discarded.", file=sys.stderr)
+
+        else:
+            save_index(CDKTF_INDEX_FILE, index)
+
+        if store:
+            store.close()
+
+    print("Updated: {}, failed: {}".format(len(files) - failed, failed))
+    print(stats)
+
+    if failed:
+        sys.exit(1)
 
 except Exception:
     traceback.print_exc()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+import os
+import heapq
+import tempfile
+import itertools
+
+CHUNK_SIZE = 1000000
+
+
+def write_run(chunk, tmp_dir=None):
+    (fd, fname) = tempfile.mkstemp(prefix='domains-', suffix='.run', dir=tmp_dir)
+
+    with os.fdopen(fd, 'w', buffering=1024 * 1024) as fd:
+        fd.write('\n'.join(sorted(chunk)) + '\n')
+
+    return fname
+
+
+def read_run(fname):
+    with open(fname, buffering=1024 * 1024) as fd:
+        for line in fd:
+            yield line.rstrip('\n')
+
+
+def external_sort(itr_data, chunk_size=CHUNK_SIZE, tmp_dir=None):
+    # Sorted unique stream: up to chunk_size lines are kept in memory,
+    # larger inputs are spilled into sorted runs and merged back.
+    runs = list()
+    chunk = set()
+
+    try:
+        for line in itr_data:
+            chunk.add(line)
+
+            if len(chunk) >= chunk_size:
+                runs.append(write_run(chunk, tmp_dir))
+                chunk = set()
+
+        if not runs:
+            yield from sorted(chunk)
+            return
+
+        if chunk:
+            runs.append(write_run(chunk, tmp_dir))
+            chunk = set()
+
+        prev = None
+        for line in heapq.merge(*map(read_run, runs)):
+            if line != prev:
+                prev = line
+                yield line
+
+    finally:
+        for fname in runs:
+            os.unlink(fname)
+
+
+def memory_join(left, right):
+    left = set(left)
+    right = set(right)
+
+    for line in sorted(left | right):
+        yield (line, line in left, line in right)
+
+
+def merge_join(left, right):
+    # Both inputs must be sorted and unique, e.g. from external_sort().
+    items = heapq.merge(((line, 0) for line in left), ((line, 1) for line in right))
+
+    for (line, group) in itertools.groupby(items, key=lambda item: item[0]):
+        sides = set(side for (_, side) in group)
+        yield (line, 0 in sides, 1 in sides)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+import os
+import re
+import sys
+import json
+import shutil
+import hashlib
+import ipaddress
+import itertools
+
+from urllib import request as urllib
+from urllib import error as urlerror
+from concurrent import futures
+
+URL_RE = re.compile(r'^https?://', re.IGNORECASE)
+HOSTS_SKIP = {'localhost', 'localhost.localdomain', 'local', 'broadcasthost', 'ip6-localhost', 'ip6-loopback', '0.0.0.0'}
+
+
+def is_address(value):
+    try:
+        ipaddress.ip_address(value)
+        return True
+
+    except ValueError:
+        return False
+
+
+def fetch_url(url, cache_dir, timeout=60):
+    # Conditional GET: an unchanged feed costs one 304 response.
+    name = hashlib.sha1(url.encode()).hexdigest()
+    data_file = os.path.join(cache_dir, name + '.txt')
+    meta_file = os.path.join(cache_dir, name + '.json')
+    meta = dict()
+
+    if os.path.exists(data_file) and os.path.exists(meta_file):
+        with open(meta_file) as fd:
+            meta = json.load(fd)
+
+    headers = {'User-Agent': 'domains_to_unbound'}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+
+    if meta.get('modified'):
+        headers['If-Modified-Since'] = meta['modified']
+
+    try:
+        with urllib.urlopen(urllib.Request(url, headers=headers), timeout=timeout) as resp:
+            tmp = data_file + '.tmp'
+            with open(tmp, 'wb') as fd:
+                shutil.copyfileobj(resp, fd, 1024 * 1024)
+
+            os.replace(tmp, data_file)
+            meta = {'url': url, 'etag': resp.headers.get('ETag', ''), 'modified': resp.headers.get('Last-Modified', '')}
+
+        with open(meta_file, 'w') as fd:
+            json.dump(meta, fd)
+
+    except urlerror.HTTPError as error:
+        if error.code != 304:
+            raise
+
+    return data_file
+
+
+def fetch_source(source, cache_dir):
+    if not URL_RE.match(source):
+        return source
+
+    try:
+        return fetch_url(source, cache_dir)
+
+    except Exception as error:
+        data_file = os.path.join(cache_dir, hashlib.sha1(source.encode()).hexdigest() + '.txt')
+        if not os.path.exists(data_file):
+            raise
+
+        print('{}: {}, using cached copy'.format(source, error), file=sys.stderr)
+        return data_file
+
+
+def fetch_sources(sources, cache_dir, workers=8):
+    os.makedirs(cache_dir, exist_ok=True)
+
+    with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda source: fetch_source(source, cache_dir), sources))
+
+
+def source_reader(fname):
+    with open(fname, buffering=1024 * 1024, errors='replace') as fd:
+        for line in fd:
+            line = line.strip()
+
+            if line and line[0] not in '#!;[':
+                yield line
+
+
+def parse_line(line):
+    # adblock: ||ads.example.com^ (exceptions and path rules are skipped)
+    if line.startswith('||'):
+        (name, sep, options) = line[2:].partition('^')
+
+        if sep and not options.lstrip('|') and '/' not in name and '*' not in name:
+            yield name
+
+        return
+
+    items = line.split('#', 1)[0].split()
+
+    # hosts: 0.0.0.0 ads.example.com [more names]
+    if len(items) > 1 and is_address(items[0]):
+        for name in items[1:]:
+            if name not in HOSTS_SKIP:
+                yield name
+
+    elif len(items) == 1:
+        yield items[0]
+
+
+def source_parser(files):
+    for line in itertools.chain.from_iterable(map(source_reader, files)):
+        yield from parse_line(line)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import random
+import string
+import argparse
+import datetime
+import tempfile
+import traceback
+import subprocess
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TLDS = [('com', 50), ('net', 12), ('org', 8), ('ru', 6), ('io', 5), ('de', 5), ('info', 4), ('xyz', 4), ('co.uk', 3), ('xn--p1ai', 3)]
+PREFIXES = ['www', 'ads', 'cdn', 'api', 'track', 'metrics', 'static', 'img', 'pixel', 'analytics']
+ALPHABET = string.ascii_lowercase * 4 + string.digits + '-'
+
+STAGES = {
+    'data': ('domains_to_unbound.py', ['{plain}', '{out}', '--stub', '0.0.0.0']),
+    'nxdomain': ('domains_to_unbound.py', ['{plain}', '{out}', '--format', 'nxdomain']),
+    'compact': ('domains_to_unbound.py', ['{plain}', '{out}', '--format', 'nxdomain', '--compact', '--collapse', '50']),
+    'rpz': ('domains_to_unbound.py', ['{plain}', '{out}', '--format', 'rpz']),
+    'external': ('domains_to_unbound.py', ['{plain}', '{out}', '--format', 'nxdomain', '--chunk', '{chunk}']),
+    'sources': ('domains_to_unbound.py', ['{hosts}', '{out}', '--format', 'nxdomain', '--source', '{adblock}']),
+    'parse': ('unbound_to_domains.py', ['{config}', '{out}']),
+    'diff': ('unbound_to_domains.py', ['{config}', '{out}', '--diff', '{changed}']),
+    'diff-external': ('unbound_to_domains.py', ['{config}', '{out}', '--diff', '{changed}', '--chunk', '{chunk}'])
+}
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', dest='sizes', default='1000,10000,100000,1000000', help='Set comma separated list sizes.')
+    parser.add_argument('--stages', dest='stages', default=','.join(STAGES), help='Set comma separated stages.')
+    parser.add_argument('--seed', dest='seed', default='1', type=int, help='Set random seed.')
+    parser.add_argument('--work-dir', dest='work_dir', default='', help='Set directory for generated lists (default: temporary).')
+    parser.add_argument('--output', dest='output', default='', help='Save JSON results to a file.')
+    parser.add_argument('--compare', dest='compare', default='', help='Compare with previous JSON results.')
+    return parser.parse_args()
+
+
+def random_label(rnd, low=3, high=15):
+    label = ''.join(rnd.choices(ALPHABET, k=rnd.randint(low, high))).strip('-')
+    return label or 'x'
+
+
+def domain_generator(size, seed):
+    # Zones are reused, so most names are subdomains of a smaller
+    # set of registered domains like in real feeds.
+    rnd = random.Random(seed)
+    (tlds, weights) = zip(*TLDS)
+    zones = ['{}.{}'.format(random_label(rnd), tld) for tld in rnd.choices(tlds, weights, k=max(size // 8, 1))]
+
+    for _ in range(size):
+        name = rnd.choice(zones)
+
+        for _ in range(rnd.choices([0, 1, 2, 3], [30, 45, 20, 5])[0]):
+            prefix = rnd.choice(PREFIXES) if rnd.random() < 0.4 else random_label(rnd, 1, 20)
+            name = '{}.{}'.format(prefix, name)
+
+        yield name
+
+
+def file_writer(fname, itr_data):
+    with open(fname, 'w', buffering=1024 * 1024) as fd:
+        for line in itr_data:
+            fd.write(line + '\n')
+
+
+def generate_files(work_dir, size, seed):
+    files = dict((name, os.path.join(work_dir, '{}-{}-{}.txt'.format(name, size, seed))) for name in ('plain', 'hosts', 'adblock', 'config', 'changed'))
+    if all(map(os.path.exists, files.values())):
+        return files
+
+    domains = list(domain_generator(size, seed))
+    half = len(domains) // 2
+
+    file_writer(files['plain'], domains)
+    file_writer(files['hosts'], ('0.0.0.0 ' + line for line in domains[:half]))
+    file_writer(files['adblock'], ('||{}^'.format(line) for line in domains[half:]))
+    file_writer(files['config'], ('local-data: "{} IN A 0.0.0.0"'.format(line) for line in domains))
+
+    # About 1% removed and 1% added.
+    rnd = random.Random(seed + 1)
+    changed = [line for line in domains if rnd.random() >= 0.01]
+    changed.extend(domain_generator(max(size // 100, 1), seed + 2))
+    file_writer(files['changed'], changed)
+    return files
+
+
+def run_stage(stage, files, size):
+    (script, template) = STAGES[stage]
+    values = dict(files, out=files['plain'] + '.out', chunk=max(size // 4, 1000))
+    command = [sys.executable, os.path.join(BASE_DIR, script)] + [item.format(**values) for item in template]
+
+    start = time.monotonic()
+    cmd = subprocess.Popen(command, shell=False, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    err = cmd.stderr.read()
+
+    # wait4() reports the resource usage of this child only.
+    (_, status, usage) = os.wait4(cmd.pid, 0)
+    wall = time.monotonic() - start
+    cmd.returncode = os.waitstatus_to_exitcode(status)
+    cmd.stderr.close()
+
+    if cmd.returncode or err:
+        raise Exception('{} ({}): {}'.format(stage, size, err.decode().strip()))
+
+    os.unlink(values['out'])
+    return {
+        'stage': stage, 'size': size, 'wall': round(wall, 3),
+        'lines_sec': int(size / wall) if wall else 0, 'max_rss_kb': usage.ru_maxrss
+    }
+
+
+def get_commit():
+    cmd = subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=BASE_DIR, shell=False, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    (out, _) = cmd.communicate()
+    return out.decode().strip()
+
+
+def print_results(results, previous):
+    previous = dict(((item['stage'], item['size']), item) for item in previous)
+    print('{:<14} {:>9} {:>9} {:>12} {:>10}'.format('stage', 'size', 'wall', 'lines/s', 'rss KiB'))
+
+    for item in results:
+        line = '{stage:<14} {size:>9} {wall:>9.3f} {lines_sec:>12} {max_rss_kb:>10}'.format(**item)
+        old = previous.get((item['stage'], item['size']))
+
+        if old and old['lines_sec'] and old['max_rss_kb']:
+            line += ' ({:+.1%} lines/s, {:+.1%} rss)'.format(
+                item['lines_sec'] / old['lines_sec'] - 1, item['max_rss_kb'] / old['max_rss_kb'] - 1
+            )
+
+        print(line)
+
+
+if __name__ == '__main__':
+    try:
+        args = arg_parse()
+        sizes = [int(item) for item in args.sizes.split(',') if item]
+        stages = [item for item in args.stages.split(',') if item]
+
+        unknown = set(stages) - set(STAGES)
+        if unknown:
+            raise ValueError('Unknown stages: {}'.format(', '.join(sorted(unknown))))
+
+        report = {
+            'commit': get_commit(), 'python': sys.version.split()[0], 'seed': args.seed,
+            'started': datetime.datetime.now(datetime.timezone.utc).isoformat(), 'results': list()
+        }
+
+        with tempfile.TemporaryDirectory(prefix='domains-benchmark-') as tmp_dir:
+            for size in sizes:
+                files = generate_files(args.work_dir or tmp_dir, size, args.seed)
+
+                for stage in stages:
+                    report['results'].append(run_stage(stage, files, size))
+
+        previous = list()
+        if args.compare:
+            with open(args.compare) as fd:
+                previous = json.load(fd)['results']
+
+        print_results(report['results'], previous)
+
+        if args.output:
+            with open(args.output, 'w') as fd:
+                json.dump(report, fd, indent=2)
+
+    except Exception:
+        traceback.print_exc()
+        sys.exit(1)
@@ -1,48 +1,287 @@
 #!/usr/bin/env python3
+import os
+import re
+import time
+import shlex
 import traceback
+import subprocess
 import argparse
 import ipaddress
+import domain_sort
+import domain_sources
+
+DOMAIN_RE = re.compile(r'^(?=.{1,253}$)([a-z0-9_](?:[a-z0-9_-]{0,61}[a-z0-9_])?)(\.[a-z0-9_](?:[a-z0-9_-]{0,61}[a-z0-9_])?)*$')
+BATCH_SIZE = 65536
+
+# Zones shared by unrelated owners, never collapsed. Use --suffix-list
+# with the full public_suffix_list.dat for complete coverage.
+PUBLIC_SUFFIXES = {
+    'co.uk', 'org.uk', 'ac.uk', 'gov.uk', 'me.uk', 'com.au', 'net.au', 'org.au', 'co.nz', 'co.jp', 'ne.jp',
+    'co.kr', 'com.br', 'com.cn', 'net.cn', 'com.tr', 'com.mx', 'com.ar', 'co.in', 'co.za', 'com.ua', 'com.ru',
+    'msk.ru', 'spb.ru', 'com.sg', 'com.hk', 'com.tw',
+    'cloudfront.net', 'amazonaws.com', 's3.amazonaws.com', 'elasticbeanstalk.com', 'azurewebsites.net',
+    'cloudapp.net', 'blob.core.windows.net', 'web.core.windows.net', 'appspot.com', 'firebaseapp.com', 'web.app',
+    'googleusercontent.com', 'blogspot.com', 'github.io', 'gitlab.io', 'herokuapp.com', 'netlify.app',
+    'vercel.app', 'pages.dev', 'workers.dev', 'fastly.net', 'akamaized.net', 'azureedge.net', 'b-cdn.net',
+    'duckdns.org', 'no-ip.org', 'ddns.net', 'dyndns.org', 'ngrok.io', 'wordpress.com', 'tumblr.com'
+}
+
+RPZ_HEADER = [
+    '$TTL 300',
+    '@ IN SOA localhost. root.localhost. {} 3600 600 86400 300'.format(int(time.time())),
+    '@ IN NS localhost.'
+]
 
 
 def arg_parse():
     parser = argparse.ArgumentParser()
-    parser.add_argument('src_file', help='Set source file.')
+    parser.add_argument('src_file', help='Set source file or URL.')
     parser.add_argument('dst_file', help='Set destination file.')
+    parser.add_argument('--source', dest='sources', action='append', default=[], help='Add source file or URL (hosts, adblock or plain list).')
+    parser.add_argument('--cache-dir', dest='cache_dir', default='~/.cache/domains_to_unbound', help='Set downloaded sources cache.')
+    parser.add_argument('--workers', dest='workers', default='8', type=int, help='Set concurrent downloads.')
+    parser.add_argument('--chunk', dest='chunk', default='0', type=int, help='Set domains per sorted run to bound memory (0 - in memory).')
     parser.add_argument('--stub', dest='stub', help='Set IP stub address.')
+    parser.add_argument('--format', dest='format', choices=['data', 'nxdomain', 'redirect', 'rpz'], default='data', help='Set output directives.')
+    parser.add_argument('--compact', dest='compact', action='store_true', help='Drop domains covered by a blocked parent zone.')
+    parser.add_argument('--apply', dest='apply', action='store_true', help='Push changes to the running unbound via unbound-control.')
+    parser.add_argument('--control', dest='control', default='unbound-control', help='Set unbound-control command.')
+    parser.add_argument('--collapse', dest='collapse', default='0', type=int, help='Block zones with more than N blocked children (0 - off).')
+    parser.add_argument('--suffix-list', dest='suffix_list', default='', help='Set public suffix list file, these zones are never collapsed.')
     return parser.parse_args()
 
 
-def file_reader(fname):
-    with open(fname) as fd:
-        for line in fd:
-            line = line.rstrip()
+def file_writer(fname, itr_data):
+    with open(fname, 'w', buffering=1024 * 1024) as fd:
+        batch = list()
+
+        for line in itr_data:
+            batch.append(line)
+
+            if len(batch) >= BATCH_SIZE:
+                fd.write('\n'.join(batch) + '\n')
+                batch.clear()
 
-            if line:
-                yield line
+        if batch:
+            fd.write('\n'.join(batch) + '\n')
 
 
-def file_writer(fname, itr_data):
-    with open(fname, 'w') as fd:
-        for line in itr_data:
-            fd.write(line + '\n')
+def normalize_domain(line):
+    line = line.strip().lower().rstrip('.')
+
+    if not line or line.startswith('#'):
+        return None
 
+    if not line.isascii():
+        try:
+            line = line.encode('idna').decode()
+
+        except UnicodeError:
+            return None
+
+    # All-numeric top labels are IP literals like 0.0.0.0, not host names.
+    if line.rpartition('.')[2].isdigit():
+        return None
+
+    return line if DOMAIN_RE.match(line) else None
+
+
+def data_normalizer(itr_data, unique=True):
+    seen = set()
 
-def data_formater(itr_data, ip_addr):
     for line in itr_data:
-        template = 'local-data: "{} IN {} {}"'
-        ip_addr = ipaddress.ip_address(ip_addr)
+        line = normalize_domain(line)
+
+        if not line or line in seen:
+            continue
+
+        if unique:
+            seen.add(line)
+
+        yield line
+
 
-        if ip_addr.version == 4:
-            yield template.format(line, 'A', str(ip_addr))
+def load_suffixes(fname):
+    # public_suffix_list.dat: one rule per line, '//' comments.
+    suffixes = set(PUBLIC_SUFFIXES)
+
+    if fname:
+        with open(fname) as fd:
+            for line in fd:
+                line = line.split()
+
+                if not line or line[0].startswith(('//', '!')):
+                    continue
+
+                (wildcard, name) = ('*.', line[0][2:]) if line[0].startswith('*.') else ('', line[0])
+                name = normalize_domain(name)
+
+                if name:
+                    suffixes.add(wildcard + name)
+
+    return suffixes
+
+
+def is_public_suffix(labels, suffixes):
+    # Single labels are top-level domains, '*.ck' makes every child of ck a suffix.
+    return len(labels) < 2 or '.'.join(reversed(labels)) in suffixes or '*.' + '.'.join(reversed(labels[:-1])) in suffixes
+
+
+def data_compactor(itr_data, collapse=0, suffixes=None):
+    # Reversed-label trie: com -> example -> ads. The empty key marks
+    # a blocked zone, everything below it is already covered.
+    trie = dict()
+
+    for line in itr_data:
+        node = trie
+
+        for label in reversed(line.split('.')):
+            if '' in node:
+                break
+
+            node = node.setdefault(label, dict())
 
         else:
-            yield template.format(line, 'AAAA', str(ip_addr))
+            node.clear()
+            node[''] = True
+
+    stack = [(trie, [])]
+    while stack:
+        (node, labels) = stack.pop()
+
+        if '' in node:
+            yield '.'.join(reversed(labels))
+            continue
+
+        # Only children that are blocked zones themselves count, and
+        # public suffixes are never blocked as a whole.
+        if collapse > 0 and sum('' in child for child in node.values()) > collapse:
+            if not is_public_suffix(labels, suffixes or PUBLIC_SUFFIXES):
+                yield '.'.join(reversed(labels))
+                continue
+
+        for label in sorted(node, reverse=True):
+            stack.append((node[label], labels + [label]))
+
+
+def data_formater(itr_data, ip_addr, out_format='data'):
+    if out_format in ('data', 'redirect'):
+        if not ip_addr:
+            raise ValueError('The --stub address is required for {} format!'.format(out_format))
+
+        ip_addr = ipaddress.ip_address(ip_addr)
+        template = 'local-data: "{{}} IN {} {}"'.format('A' if ip_addr.version == 4 else 'AAAA', ip_addr)
+
+    if out_format == 'data':
+        for line in itr_data:
+            yield template.format(line)
+
+    elif out_format == 'redirect':
+        for line in itr_data:
+            yield 'local-zone: "{}" redirect'.format(line)
+            yield template.format(line)
+
+    elif out_format == 'nxdomain':
+        for line in itr_data:
+            yield 'local-zone: "{}" always_nxdomain'.format(line)
+
+    elif out_format == 'rpz':
+        yield from RPZ_HEADER
+
+        for line in itr_data:
+            yield '{} CNAME .'.format(line)
+            yield '*.{} CNAME .'.format(line)
+
+
+def control_exec(control, command, lines=None):
+    cmd = subprocess.Popen(
+        shlex.split(control) + command, shell=False, stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+
+    (out, _) = cmd.communicate('\n'.join(lines).encode() + b'\n' if lines else None)
+    out = out.decode()
+
+    if cmd.returncode or out.startswith('error'):
+        raise Exception('{}: {}'.format(' '.join(command), out.strip()))
+
+    return out
+
+
+def control_batches(control, command, lines):
+    for start in range(0, len(lines), BATCH_SIZE):
+        control_exec(control, [command], lines[start:start + BATCH_SIZE])
+
+
+def loaded_names(control, ip_addr, out_format):
+    # Only entries this tool would have generated are compared.
+    if out_format == 'data':
+        for line in control_exec(control, ['list_local_data']).splitlines():
+            items = line.split()
+
+            if len(items) > 4 and items[3] in ('A', 'AAAA') and items[4] == ip_addr:
+                yield items[0].lower().rstrip('.')
+
+    else:
+        zone_type = 'always_nxdomain' if out_format == 'nxdomain' else 'redirect'
+
+        for line in control_exec(control, ['list_local_zones']).splitlines():
+            items = line.split()
+
+            if len(items) > 1 and items[1] == zone_type:
+                yield items[0].lower().rstrip('.')
+
+
+def data_apply(domains, control, ip_addr, out_format):
+    if out_format == 'rpz':
+        raise ValueError('The rpz format can not be applied with unbound-control!')
+
+    if out_format in ('data', 'redirect'):
+        if not ip_addr:
+            raise ValueError('The --stub address is required for {} format!'.format(out_format))
+
+        ip_addr = ipaddress.ip_address(ip_addr)
+        record = '{{}} IN {} {}'.format('A' if ip_addr.version == 4 else 'AAAA', ip_addr)
+        ip_addr = str(ip_addr)
+
+    loaded = set(loaded_names(control, ip_addr, out_format))
+    domains = set(domains)
+
+    added = sorted(domains - loaded)
+    removed = sorted(loaded - domains)
+
+    if out_format in ('nxdomain', 'redirect'):
+        zone_type = 'always_nxdomain' if out_format == 'nxdomain' else 'redirect'
+        control_batches(control, 'local_zones_remove', removed)
+        control_batches(control, 'local_zones', ['{} {}'.format(line, zone_type) for line in added])
+
+    if out_format in ('data', 'redirect'):
+        control_batches(control, 'local_datas_remove', removed)
+        control_batches(control, 'local_datas', [record.format(line) for line in added])
+
+    print('Apply: +{} -{}'.format(len(added), len(removed)))
 
 
 if __name__ == '__main__':
     try:
         args = arg_parse()
-        file_writer(args.dst_file, data_formater(file_reader(args.src_file), args.stub))
+        if args.compact and args.format == 'data':
+            raise ValueError('The data format does not cover subdomains, use --compact with a zone format!')
+
+        files = domain_sources.fetch_sources([args.src_file] + args.sources, os.path.expanduser(args.cache_dir), args.workers)
+        domains = data_normalizer(domain_sources.source_parser(files), not (args.compact or args.chunk > 0))
+
+        if args.chunk > 0:
+            domains = domain_sort.external_sort(domains, args.chunk)
+
+        if args.compact:
+            domains = data_compactor(domains, args.collapse, load_suffixes(args.suffix_list))
+
+        if args.apply:
+            domains = list(domains)
+            data_apply(domains, args.control, args.stub, args.format)
+
+        file_writer(args.dst_file, data_formater(domains, args.stub, args.format))
 
     except Exception:
         traceback.print_exc()
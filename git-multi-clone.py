@@ -1,15 +1,31 @@
 #!/usr/bin/env python3
+import os
 import sys
+import time
 import pathlib
 import argparse
+import collections
 import traceback
 import subprocess
+import git_mirror
+import git_report
+
+from urllib import parse as urllib
+from concurrent import futures
 
 
 def get_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
     parser.add_argument("repo_base", help="Set repository base dir.")
     parser.add_argument("repo_list", help="Set repository list file.")
+    parser.add_argument("--workers", dest="workers", default="8", type=int, help="Set clone concurrency.")
+    parser.add_argument("--per-host", dest="per_host", default="4", type=int, help="Set clone concurrency per host.")
+    parser.add_argument("--filter", dest="filter", default="", help="Set partial clone filter, e.g. blob:none.")
+    parser.add_argument("--depth", dest="depth", default="0", type=int, help="Set shallow clone depth.")
+    parser.add_argument("--report", dest="report", default="", help="Save JSON run report to a file.")
+    parser.add_argument("--top", dest="top", default="10", type=int, help="Set slowest repositories summary size (0 - all).")
+    parser.add_argument("--mirror-cache", dest="mirror_cache", default="", help="Set local mirror cache directory.")
+    parser.add_argument("--dissociate", dest="dissociate", action="store_true", help="Copy objects from the mirror cache.")
     return parser.parse_args()
 
 
@@ -18,23 +34,149 @@ def read_repo_list(filename: str) -> list:
     return list(filter(None, data.split("\n")))
 
 
-def clone_repo(repo_name: str, base_dir: str) -> int:
+def get_repo_host(repo_name: str) -> str:
+    url = urllib.urlparse(repo_name)
+    if url.netloc:
+        return url.hostname or url.netloc
+
+    # scp-like syntax: user@host:path
+    return repo_name.split(":", 1)[0].split("@")[-1]
+
+
+def get_repo_dir(repo_name: str) -> str:
+    name = repo_name.rstrip("/").rsplit("/", 1)[-1].rsplit(":", 1)[-1]
+    return name[:-4] if name.endswith(".git") else name
+
+
+def clone_repo(repo_name: str, base_dir: str, options: list = None) -> tuple:
     cmd = subprocess.Popen(
-        ['/usr/bin/git', 'clone', repo_name],
+        ['/usr/bin/git', 'clone', '--progress'] + (options or []) + [repo_name],
         stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
         cwd=base_dir, shell=False
     )
 
-    return cmd.wait()
+    (_, err) = cmd.communicate()
+    return (cmd.returncode, err.decode(errors="replace"))
+
+
+class CloneScheduler:
+    def __init__(self, base_dir: str, workers: int, per_host: int, options: list, cache: git_mirror.MirrorCache = None) -> None:
+        self._base = base_dir
+        self._cache = cache
+        self._workers = workers
+        self._per_host = per_host
+        self._options = options
+
+    def _clone(self, repo_name: str, queued: float) -> dict:
+        start = time.monotonic()
+        options = list(self._options)
+        mirror = None
+
+        if self._cache:
+            mirror = self._cache.update(repo_name)
+            if mirror:
+                options.extend(["--reference-if-able", str(mirror)])
+
+        (status, err) = clone_repo(repo_name, self._base, options)
+        if mirror and not status and "--dissociate" not in options:
+            self._cache.register(mirror, os.path.join(self._base, get_repo_dir(repo_name)))
+
+        return {
+            "repo": repo_name, "status": status, "stderr": err, "time": time.monotonic() - start,
+            "wait": start - queued, "received": git_report.parse_received(err)
+        }
+
+    def _clone_safe(self, repo_name: str, queued: float) -> dict:
+        # A failing mirror update or spawn is one failed repository, not a stopped run.
+        try:
+            return self._clone(repo_name, queued)
+
+        except Exception as error:
+            return {
+                "repo": repo_name, "status": -1, "stderr": "{}: {}".format(type(error).__name__, error),
+                "time": 0.0, "wait": time.monotonic() - queued, "received": 0
+            }
+
+    def run(self, repo_list: list) -> list:
+        results = list()
+        queues = dict()
+        queued = time.monotonic()
+
+        for repo_name in repo_list:
+            if os.path.exists(os.path.join(self._base, get_repo_dir(repo_name))):
+                print("Clone {}: skipped".format(repo_name))
+                continue
+
+            queues.setdefault(get_repo_host(repo_name), collections.deque()).append(repo_name)
+
+        running = dict()
+        active = collections.Counter()
+
+        with futures.ThreadPoolExecutor(max_workers=self._workers) as pool:
+            while queues or running:
+                # Jobs are submitted only for hosts with a free slot, so a worker
+                # never sits blocked on one host while other hosts are waiting.
+                for host in list(queues):
+                    while queues[host] and active[host] < self._per_host and len(running) < self._workers:
+                        running[pool.submit(self._clone_safe, queues[host].popleft(), queued)] = host
+                        active[host] += 1
+
+                    if not queues[host]:
+                        del queues[host]
+
+                (done, _) = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+
+                for job in done:
+                    active[running.pop(job)] -= 1
+                    item = job.result()
+                    print("Clone {}: {} ({:.1f}s)".format(item["repo"], item["status"], item["time"]))
+                    results.append(item)
+
+        return results
+
+
+def print_summary(results: list) -> None:
+    failed = list(filter(lambda item: item["status"], results))
+    print("\nCloned: {}, failed: {}".format(len(results) - len(failed), len(failed)))
+
+    for item in failed:
+        print("\nFailure {}:".format(item["repo"]))
+        for line in git_report.clean_output(item["stderr"])[-5:]:
+            print("\t{}".format(line))
 
 
 try:
     args = get_args()
+    options = list()
+
+    if args.workers < 1 or args.per_host < 1:
+        raise ValueError("--workers and --per-host must be at least 1!")
+
+    if args.filter:
+        options.append("--filter={}".format(args.filter))
+
+    if args.depth > 0:
+        options.append("--depth={}".format(args.depth))
+
+    if args.dissociate:
+        options.append("--dissociate")
+
+    cache = git_mirror.MirrorCache(args.mirror_cache) if args.mirror_cache else None
+    scheduler = CloneScheduler(args.repo_base, args.workers, args.per_host, options, cache)
+    results = scheduler.run(read_repo_list(args.repo_list))
+    print_summary(results)
+
+    report = git_report.RunReport("git-multi-clone")
+    for item in results:
+        report.add(item["repo"], item["status"], item["time"], item["wait"], item["received"])
+
+    report.print_slowest(args.top)
+    if args.report:
+        report.save(args.report, args.top)
 
-    for repo_name in read_repo_list(args.repo_list):
-        print("Clone {}: ".format(repo_name), end="")
-        print(clone_repo(repo_name, args.repo_base))
+    if any(item["status"] for item in results):
+        sys.exit(1)
 
 except Exception:
     traceback.print_exc()
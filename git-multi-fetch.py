@@ -1,81 +1,325 @@
 #!/usr/bin/env python3
 import os
-import queue
-import typing
+import json
+import time
+import shutil
+import signal
+import asyncio
 import pathlib
 import argparse
 import traceback
-import threading
 import subprocess
+import git_mirror
+import git_report
+import git_collection
 
 
-class GitCollection:
-    def __init__(self, base_dir: str) -> None:
-        self._base = pathlib.Path(base_dir)
-        self._list = list()
+def read_remote_refs(git_repo: str, remote: str = 'origin') -> dict:
+    # Returns {'refs/heads/<branch>': sha} without spawning git.
+    git_dir = pathlib.Path(git_repo, '.git')
+    prefix = 'refs/remotes/{}/'.format(remote)
+    refs = dict()
 
-    def __iter__(self) -> typing.Iterator:
-        return map(lambda it: str(it.parent), self._list)
+    packed = git_dir.joinpath('packed-refs')
+    if packed.exists():
+        for line in packed.read_text().split('\n'):
+            if line and line[0] not in '#^':
+                (sha, _, name) = line.partition(' ')
+                if name.startswith(prefix):
+                    refs[name[len(prefix):]] = sha
 
-    def update(self) -> None:
-        for sub_dir in self._base.iterdir():
-            if sub_dir.is_dir():
-                sub_items = filter(lambda it: it.is_dir(), sub_dir.iterdir())
-                sub_items = map(lambda it: it.joinpath('.git'), sub_items)
-                sub_items = filter(lambda it: it.exists(), sub_items)
-                self._list.extend(sub_items)
+    loose = git_dir.joinpath(prefix)
+    if loose.is_dir():
+        for (root, _, files) in os.walk(loose):
+            for name in files:
+                data = pathlib.Path(root, name).read_text().strip()
+                if not data.startswith('ref:'):
+                    refs[os.path.relpath(os.path.join(root, name), loose)] = data
+
+    return {'refs/heads/' + name: sha for (name, sha) in refs.items() if name != 'HEAD'}
 
 
 class GitUpdate:
-    def __init__(self, git_list: GitCollection) -> None:
+    _prefix = list()
+
+    def __init__(self, git_list: git_collection.GitCollection, cache: git_mirror.MirrorCache = None, jobs: int = 8, timeout: int = 300, retries: int = 2, skip: bool = False) -> None:
         self._list = list(git_list)
         self._fail = list()
+        self._cache = cache
+        self._done = 0
 
-        self._queue = queue.Queue()
-        self._cpus = os.cpu_count()
+        self._skip = skip
+        self._heads = dict()
+        self.report = git_report.RunReport('git-multi-fetch')
 
-        if not self._cpus:
-            self._cpus = 2
+        self._jobs = max(jobs, 1)
+        self._timeout = timeout
+        self._retries = retries
 
-    def _git_exec(self) -> None:
-        while not self._queue.empty():
-            git_repo = self._queue.get()
+    def _git_origin(self, git_repo: str) -> str:
+        cmd = subprocess.run(
+            ['/usr/bin/git', 'config', '--get', 'remote.origin.url'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=git_repo, shell=False
+        )
 
-            cmd = subprocess.Popen(
-                ['/usr/bin/git', 'pull', 'origin', '--rebase'],
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-                cwd=git_repo, shell=False
-            )
+        return cmd.stdout.decode().strip()
 
-            if cmd.wait():
-                self._fail.append(git_repo)
+    def _git_tracked(self, git_repo: str) -> set:
+        # Single-branch clones fetch only some heads, None means all of them.
+        cmd = subprocess.run(
+            ['/usr/bin/git', 'config', '--get-all', 'remote.origin.fetch'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=git_repo, shell=False
+        )
 
-            print('Repo:', git_repo)
-            self._queue.task_done()
+        specs = [line.lstrip('+').split(':')[0] for line in cmd.stdout.decode().split()]
+        return None if any(spec.endswith('/*') for spec in specs) else set(specs)
 
-    def update(self) -> None:
-        print('Repositories:', len(self._list))
+    def _git_synced(self, git_repo: str) -> bool:
+        # A failed rebase or a manual fetch leaves the branch behind its upstream.
+        cmd = subprocess.run(
+            ['/usr/bin/git', 'merge-base', '--is-ancestor', '@{upstream}', 'HEAD'],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            cwd=git_repo, shell=False
+        )
+
+        return not cmd.returncode
+
+    def _git_link(self, git_repo: str) -> None:
+        origin = self._git_origin(git_repo)
+        if origin:
+            self._cache.link(git_repo, origin)
+
+    async def _git_run(self, git_repo: str, args: list = None) -> tuple:
+        cmd = await asyncio.create_subprocess_exec(
+            *self._prefix, '/usr/bin/git', *(args or ['pull', '--progress', '--rebase', 'origin']),
+            stdout=asyncio.subprocess.PIPE if args else asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=git_repo, env=dict(os.environ, GIT_TERMINAL_PROMPT='0'),
+            start_new_session=True
+        )
+
+        try:
+            (out, err) = await asyncio.wait_for(cmd.communicate(), self._timeout)
+            return (cmd.returncode, (out or err).decode(errors='replace'))
+
+        except asyncio.TimeoutError:
+            # Kill the whole group, children like ssh keep the stderr pipe open.
+            try:
+                os.killpg(cmd.pid, signal.SIGKILL)
+
+            except ProcessLookupError:
+                pass
+
+            await cmd.wait()
+            return (-1, 'Timeout after {}s'.format(self._timeout))
+
+    async def _git_heads(self, git_repo: str, url: str) -> dict:
+        (status, out) = await self._git_run(git_repo, ['ls-remote', '--heads', url])
+        if status:
+            return None
+
+        lines = map(lambda line: line.split('\t'), filter(None, out.split('\n')))
+        return {name: sha for (sha, name) in lines}
+
+    async def _git_changed(self, git_repo: str) -> bool:
+        url = await asyncio.to_thread(self._git_origin, git_repo)
+        if not url:
+            return True
+
+        # Checkouts of the same remote share a single ls-remote call.
+        if url not in self._heads:
+            self._heads[url] = asyncio.ensure_future(self._git_heads(git_repo, url))
 
-        for item in self._list:
-            self._queue.put(item)
+        heads = await self._heads[url]
+        if heads is None:
+            return True
 
-        for tid in range(self._cpus):
-            thr_item = threading.Thread(target=self._git_exec)
-            print('Start worker:', tid)
-            thr_item.start()
+        if not await asyncio.to_thread(self._git_synced, git_repo):
+            return True
 
-        self._queue.join()
+        tracked = await asyncio.to_thread(self._git_tracked, git_repo)
+        local = await asyncio.to_thread(read_remote_refs, git_repo)
+        return any(local.get(name) != sha for (name, sha) in heads.items() if tracked is None or name in tracked)
+
+    async def _git_exec(self, git_repo: str, slots: asyncio.Semaphore) -> None:
+        queued = time.monotonic()
+
+        async with slots:
+            started = time.monotonic()
+
+            if self._skip and not await self._git_changed(git_repo):
+                self._done += 1
+                self.report.add(git_repo, 'unchanged', time.monotonic() - started, started - queued)
+                print('[{}/{}] Repo: {} (unchanged)'.format(self._done, len(self._list), git_repo))
+                return
+
+            if self._cache:
+                await asyncio.to_thread(self._git_link, git_repo)
+
+            for attempt in range(self._retries + 1):
+                if attempt:
+                    await asyncio.sleep(2 ** attempt)
+
+                (status, err) = await self._git_run(git_repo)
+                if not status:
+                    break
+
+            self.report.add(git_repo, status, time.monotonic() - started, started - queued, git_report.parse_received(err))
+
+        self._done += 1
+        print('[{}/{}] Repo: {}{}'.format(self._done, len(self._list), git_repo, ' (failed)' if status else ''))
+
+        if status:
+            self._fail.append((git_repo, err))
+
+    async def _git_safe(self, git_repo: str, slots: asyncio.Semaphore) -> None:
+        # One broken repository must not cancel the other jobs.
+        try:
+            await self._git_exec(git_repo, slots)
+
+        except Exception as error:
+            self._done += 1
+            self._fail.append((git_repo, '{}: {}'.format(type(error).__name__, error)))
+            self.report.add(git_repo, 'error', 0, 0)
+            print('[{}/{}] Repo: {} (failed)'.format(self._done, len(self._list), git_repo))
+
+    async def _update(self) -> None:
+        slots = asyncio.Semaphore(self._jobs)
+        await asyncio.gather(*[self._git_safe(item, slots) for item in self._list])
+
+    def update(self) -> None:
+        print('Repositories:', len(self._list))
+        asyncio.run(self._update())
 
         if self._fail:
             print('\nUpdate failure:')
-            for item in self._fail:
+            for (item, err) in self._fail:
                 print('-', item)
+                for line in git_report.clean_output(err)[-5:]:
+                    print('\t', line, sep='')
+
+
+class GitMaintenance(GitUpdate):
+    TASKS = [
+        ['pack-refs', '--all'],
+        ['repack', '-d', '-q'],
+        ['multi-pack-index', 'write'],
+        ['commit-graph', 'write', '--reachable', '--split']
+    ]
+
+    STATE_FILE = 'multi-fetch-maintenance.json'
+
+    def __init__(self, git_list: git_collection.GitCollection, jobs: int = 8, timeout: int = 300, max_age: int = 24, max_loose: int = 100) -> None:
+        # Maintenance is CPU and disk bound, so it never takes more than half of the CPUs.
+        super().__init__(git_list, None, min(jobs, max((os.cpu_count() or 2) // 2, 1)), timeout, 0)
+        self.report = git_report.RunReport('git-multi-fetch-maintenance')
+
+        self._max_age = max_age * 3600
+        self._max_loose = max_loose
+
+        if shutil.which('ionice') and shutil.which('nice'):
+            self._prefix = ['ionice', '-c', '3', 'nice', '-n', '10']
+
+    def _git_dir(self, git_repo: str) -> str:
+        # Worktrees and submodules keep objects outside of '<repo>/.git'.
+        cmd = subprocess.run(
+            ['/usr/bin/git', 'rev-parse', '--git-common-dir'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=git_repo, shell=False
+        )
+
+        if cmd.returncode:
+            raise Exception(cmd.stderr.decode().strip())
+
+        return os.path.join(git_repo, cmd.stdout.decode().strip())
+
+    def _get_counts(self, git_repo: str) -> dict:
+        objects = os.path.join(self._git_dir(git_repo), 'objects')
+        (loose, packs) = (0, 0)
+
+        with os.scandir(objects) as entries:
+            for entry in entries:
+                if len(entry.name) == 2 and entry.is_dir():
+                    loose += len(os.listdir(entry.path))
+
+                elif entry.name == 'pack':
+                    packs = len([name for name in os.listdir(entry.path) if name.endswith('.pack')])
+
+        return {'loose': loose, 'packs': packs}
+
+    def _is_fresh(self, git_repo: str, counts: dict) -> bool:
+        state_file = os.path.join(self._git_dir(git_repo), self.STATE_FILE)
+        if not os.path.exists(state_file):
+            return False
+
+        # A broken state file only means the repository is maintained again.
+        try:
+            with open(state_file) as fd:
+                state = json.load(fd)
+
+            return time.time() - state['time'] < self._max_age and counts['loose'] <= state['loose'] + self._max_loose and counts['packs'] <= state['packs']
+
+        except (ValueError, KeyError, TypeError):
+            return False
+
+    def _save_state(self, git_repo: str) -> None:
+        state = dict(self._get_counts(git_repo), time=time.time())
+        with open(os.path.join(self._git_dir(git_repo), self.STATE_FILE), 'w') as fd:
+            json.dump(state, fd)
+
+    async def _git_exec(self, git_repo: str, slots: asyncio.Semaphore) -> None:
+        queued = time.monotonic()
+        (status, err) = (0, '')
+
+        async with slots:
+            started = time.monotonic()
+
+            # Back off while the machine is already saturated.
+            while os.getloadavg()[0] > (os.cpu_count() or 2):
+                await asyncio.sleep(5)
+
+            counts = await asyncio.to_thread(self._get_counts, git_repo)
+            fresh = await asyncio.to_thread(self._is_fresh, git_repo, counts)
+
+            if not fresh:
+                for task in self.TASKS:
+                    (status, err) = await self._git_run(git_repo, task)
+                    if status:
+                        break
+
+                else:
+                    await asyncio.to_thread(self._save_state, git_repo)
+
+            self.report.add(git_repo, 'fresh' if fresh else status, time.monotonic() - started, started - queued)
+
+        self._done += 1
+        print('[{}/{}] Repo: {}{}'.format(self._done, len(self._list), git_repo, ' (fresh)' if fresh else ' (failed)' if status else ''))
+
+        if status:
+            self._fail.append((git_repo, err))
 
 
 def get_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
     parser.add_argument('dir_base', help='Set repositories collection directory.')
+    parser.add_argument('--depth', dest='depth', default='2', type=int, help='Set repositories search depth.')
+    parser.add_argument('--index', dest='index', default='', help='Set repositories discovery index file.')
+    parser.add_argument('--scan-workers', dest='scan_workers', default='0', type=int, help='Set parallel discovery workers.')
+    parser.add_argument('--jobs', dest='jobs', default='8', type=int, help='Set concurrent pulls.')
+    parser.add_argument('--timeout', dest='timeout', default='300', type=int, help='Set pull timeout per repository in seconds.')
+    parser.add_argument('--retries', dest='retries', default='2', type=int, help='Set pull retries per repository.')
+    parser.add_argument('--skip-unchanged', dest='skip', action='store_true', help='Pull only repositories with moved remote heads.')
+    parser.add_argument('--report', dest='report', default='', help='Save JSON run report to a file.')
+    parser.add_argument('--top', dest='top', default='10', type=int, help='Set slowest repositories summary size (0 - all).')
+    parser.add_argument('--maintenance', dest='maintenance', action='store_true', help='Run repository maintenance instead of pull.')
+    parser.add_argument('--max-age', dest='max_age', default='24', type=int, help='Set maintenance freshness in hours.')
+    parser.add_argument('--mirror-cache', dest='mirror_cache', default='', help='Set local mirror cache directory.')
     return parser.parse_args()
 
 
@@ -83,11 +327,21 @@ if __name__ == '__main__':
     try:
         args = get_args()
 
-        dirs = GitCollection(args.dir_base)
+        dirs = git_collection.GitCollection(args.dir_base, args.depth, args.index, args.scan_workers)
         dirs.update()
 
-        repos = GitUpdate(dirs)
+        if args.maintenance:
+            repos = GitMaintenance(dirs, args.jobs, args.timeout, args.max_age)
+
+        else:
+            cache = git_mirror.MirrorCache(args.mirror_cache, args.timeout) if args.mirror_cache else None
+            repos = GitUpdate(dirs, cache, args.jobs, args.timeout, args.retries, args.skip)
+
         repos.update()
+        repos.report.print_slowest(args.top)
+
+        if args.report:
+            repos.report.save(args.report, args.top)
 
     except Exception:
         traceback.print_exc()
@@ -1,30 +1,157 @@
 #!/usr/bin/env python3
-import subprocess
-import traceback
+import sys
+import time
 import json
+import typing
+import argparse
+import threading
+import traceback
+import subprocess
+
+from concurrent import futures
 
+FORKS_QUERY = """
+query($owner: String!, $endCursor: String) {
+  repositoryOwner(login: $owner) {
+    repositories(first: 100, isFork: true, after: $endCursor) {
+      nodes {
+        nameWithOwner
+        defaultBranchRef { name target { oid } }
+        parent { nameWithOwner defaultBranchRef { name target { oid } } }
+      }
+      pageInfo { hasNextPage endCursor }
+    }
+  }
+}
+"""
 
-def list_forks() -> list:
+
+def gh_exec(args: list) -> str:
     cmd = subprocess.Popen(
-        ["gh", "repo", "list", "--fork", "--json", "nameWithOwner,defaultBranchRef"],
-        shell=False, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        ["gh"] + args, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE
     )
 
-    (out, _) = cmd.communicate()
-    return list(map(lambda item: [item["nameWithOwner"], item["defaultBranchRef"]["name"]], json.loads(out)))
+    (out, err) = cmd.communicate()
+    if cmd.returncode:
+        raise Exception("gh {}: {}".format(" ".join(args[:2]), err.decode().strip()))
+
+    return out.decode()
+
+
+def parse_pages(data: str) -> typing.Iterator:
+    # gh api --paginate prints one JSON document per page.
+    decoder = json.JSONDecoder()
+    offset = 0
+
+    while offset < len(data):
+        if data[offset].isspace():
+            offset += 1
+            continue
+
+        (page, offset) = decoder.raw_decode(data, offset)
+        yield page
+
+
+def get_branch(item: dict) -> tuple:
+    ref = (item or {}).get("defaultBranchRef") or {}
+    return (ref.get("name", ""), (ref.get("target") or {}).get("oid", ""))
+
+
+def list_forks(owner: str) -> list:
+    data = gh_exec(["api", "graphql", "--paginate", "-f", "query=" + FORKS_QUERY, "-F", "owner=" + owner])
+    forks = list()
+
+    for page in parse_pages(data):
+        for item in page["data"]["repositoryOwner"]["repositories"]["nodes"]:
+            (branch, head) = get_branch(item)
+            (parent_branch, parent_head) = get_branch(item.get("parent"))
+
+            if branch:
+                forks.append({
+                    "name": item["nameWithOwner"], "branch": branch,
+                    "synced": branch == parent_branch and head == parent_head
+                })
 
+    return forks
 
-def sync_fork(repo_name: str, repo_branch: str) -> int:
+
+class RateLimit:
+    def __init__(self, reserve: int = 100, cost: int = 3) -> None:
+        self._lock = threading.Lock()
+        self._reserve = reserve
+        self._cost = cost
+        self._remaining = 0
+        self._reset = 0
+
+    def _refresh(self) -> None:
+        data = json.loads(gh_exec(["api", "rate_limit"]))
+        self._remaining = data["resources"]["core"]["remaining"]
+        self._reset = data["resources"]["core"]["reset"]
+
+    def acquire(self) -> None:
+        # Waits for the quota reset instead of running into 403 responses.
+        with self._lock:
+            while self._remaining - self._cost < self._reserve:
+                self._refresh()
+
+                if self._remaining - self._cost < self._reserve:
+                    delay = max(self._reset - time.time(), 0) + 1
+                    print("Rate limit: {} left, waiting {:.0f}s".format(self._remaining, delay), file=sys.stderr)
+                    time.sleep(delay)
+
+            self._remaining -= self._cost
+
+
+def sync_fork(repo_name: str, repo_branch: str) -> tuple:
     cmd = subprocess.Popen(
-        ["gh", "repo", "sync", repo_name, "--force", "--branch", repo_branch], shell=False
+        ["gh", "repo", "sync", repo_name, "--force", "--branch", repo_branch],
+        shell=False, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
     )
 
-    return cmd.wait()
+    (out, _) = cmd.communicate()
+    return (cmd.returncode, out.decode().strip())
+
+
+def run_sync(limit: RateLimit, item: dict) -> tuple:
+    limit.acquire()
+    return sync_fork(item["name"], item["branch"])
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("owners", nargs="*", help="Set users or organizations (default: current user).")
+    parser.add_argument("--workers", dest="workers", default="4", type=int, help="Set concurrent syncs.")
+    parser.add_argument("--reserve", dest="reserve", default="100", type=int, help="Set API quota kept in reserve.")
+    parser.add_argument("--force-all", dest="force_all", action="store_true", help="Sync forks already matching the parent.")
+    return parser.parse_args()
 
 
 try:
-    for (name, branch) in list_forks():
-        sync_fork(name, branch)
+    args = get_args()
+    owners = args.owners or [gh_exec(["api", "user", "--jq", ".login"]).strip()]
+    limit = RateLimit(args.reserve)
+
+    forks = [item for owner in owners for item in list_forks(owner)]
+    jobs = dict()
+    failed = 0
+
+    with futures.ThreadPoolExecutor(max_workers=args.workers) as pool:
+        for item in forks:
+            if item["synced"] and not args.force_all:
+                print("{}: up to date".format(item["name"]))
+                continue
+
+            jobs[pool.submit(run_sync, limit, item)] = item
+
+        for job in futures.as_completed(jobs):
+            (status, out) = job.result()
+            print("{}: {}".format(jobs[job]["name"], out or status))
+            failed += bool(status)
+
+    print("Forks: {}, synced: {}, failed: {}".format(len(forks), len(jobs) - failed, failed))
+
+    if failed:
+        sys.exit(1)
 
 except Exception:
     traceback.print_exc()
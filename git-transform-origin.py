@@ -1,89 +1,145 @@
 #!/usr/bin/env python3
 from urllib import parse as urllib
+from concurrent import futures
 
-import typing
+import os
+import re
+import difflib
 import pathlib
 import argparse
 import traceback
+import git_collection
 
 
-class GitCollection:
-    def __init__(self, base_dir: str) -> None:
-        self._base = pathlib.Path(base_dir)
-        self._list = list()
+SECTION_RE = re.compile(r'^\s*\[\s*([\w.-]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\]')
+URL_RE = re.compile(r'^(\s*(?:push)?url\s*=\s*)(\S+)(\s*)$', re.IGNORECASE)
 
-    def __iter__(self) -> typing.Iterator:
-        return iter(self._list)
 
-    def update(self) -> None:
-        sub_items = filter(lambda it: it.is_dir(), self._base.iterdir())
-        sub_items = map(lambda it: it.joinpath('.git/config'), sub_items)
-        self._list = list(filter(lambda it: it.exists(), sub_items))
+class UrlRules:
+    def __init__(self, rules: list = None, hosts: dict = None, direction: str = 'ssh') -> None:
+        self._rules = [(re.compile(pattern), repl) for (pattern, repl) in (rules or [])]
+        self._hosts = {old.lower(): new for (old, new) in (hosts or dict()).items()}
+        self._direction = direction
 
+    def _split(self, url: str) -> tuple:
+        # Returns (scheme, user, host, port, path) for URL and scp-like syntax, or None for local paths.
+        # The host keeps its original case, so it can be replaced in place.
+        tmp = urllib.urlparse(url)
+        if tmp.netloc and tmp.scheme != 'file':
+            host = tmp.netloc.rpartition('@')[2]
+            host = host.rsplit(':', 1)[0] if tmp.port else host
+            return (tmp.scheme.lower(), tmp.username, host, tmp.port, tmp.path[1:])
 
-class GitTransform:
-    def __init__(self, git_list: GitCollection) -> None:
-        self._list = iter(git_list)
-        self._stat = False
+        if not tmp.scheme and ':' in url and '/' not in url.split(':', 1)[0]:
+            (host, _, path) = url.partition(':')
+            (user, _, host) = host.rpartition('@')
+            return ('ssh', user, host, None, path)
 
-    def _load_config(self, cfg_path: pathlib.Path) -> list:
-        git_data = list()
+        return None
 
-        with cfg_path.open('r') as fd:
-            lines = map(str.lstrip, fd)
-            lines = map(str.rstrip, lines)
-            git_data.extend(filter(None, lines))
+    def apply(self, url: str) -> str:
+        for (pattern, repl) in self._rules:
+            url = pattern.sub(repl, url)
 
-        return git_data
+        tmp = self._split(url)
+        if not tmp:
+            return url
+
+        (scheme, user, host, port, path) = tmp
+        ssh = scheme in ('ssh', 'git+ssh')
+        host = self._hosts.get(host.lower(), host)
+
+        if self._direction == 'ssh':
+            # The scp-like syntax can not carry a port, a custom one needs ssh://.
+            user = user if ssh and user else 'git'
+            if ssh and port:
+                return 'ssh://{}@{}:{}/{}'.format(user, host, port, path)
+
+            return '{}@{}:{}'.format(user, host, path)
+
+        elif self._direction == 'https':
+            if scheme == 'https' and port:
+                host = '{}:{}'.format(host, port)
+
+            return 'https://{}/{}'.format(host, path)
+
+        return url.replace(tmp[2], host, 1)
+
+
+class GitTransform:
+    def __init__(self, git_list: git_collection.GitCollection, rules: UrlRules, remotes: list = None, dry_run: bool = False, workers: int = 8) -> None:
+        self._list = map(lambda it: pathlib.Path(it, '.git', 'config'), git_list)
+        self._rules = rules
+        self._remotes = set(remotes or [])
+        self._dry_run = dry_run
+        self._workers = max(workers, 1)
+
+    def _load_config(self, cfg_path: pathlib.Path) -> list:
+        with cfg_path.open('r', newline='') as fd:
+            return fd.readlines()
 
     def _transform_config(self, git_conf_data: list) -> list:
-        template = 'git@{}:{}'
+        # Only url lines are touched, everything else is kept byte-for-byte.
         git_data = list()
-        self._stat = False
+        selected = not self._remotes
 
         for line in git_conf_data:
-            if line.startswith('url'):
-                tmp = line.split()
-                url = urllib.urlparse(tmp[-1])
+            section = SECTION_RE.match(line)
+            if section:
+                selected = not self._remotes or (section.group(1).lower() == 'remote' and section.group(2) in self._remotes)
 
-                if not url.netloc:
-                    git_data.append(line)
-
-                else:
-                    tmp[-1] = template.format(url.netloc, url.path[1:])
-                    git_data.append(' '.join(tmp))
-                    self._stat = True
+            tmp = URL_RE.match(line.rstrip('\r\n'))
+            if selected and tmp and not section:
+                ending = line[len(line.rstrip('\r\n')):]
+                line = tmp.group(1) + self._rules.apply(tmp.group(2)) + tmp.group(3) + ending
 
-            else:
-                git_data.append(line)
+            git_data.append(line)
 
         return git_data
 
     def _save_config(self, cfg_path: pathlib.Path, git_data: list) -> None:
-        with cfg_path.open('w') as fd:
-            for line in git_data:
-                if line.startswith('['):
-                    print(line, sep='', file=fd)
+        tmp = cfg_path.with_name(cfg_path.name + '.tmp')
 
-                else:
-                    print('\t', line, sep='', file=fd)
+        with tmp.open('w', newline='') as fd:
+            fd.writelines(git_data)
 
-    def transform(self) -> None:
-        for item in self._list:
-            config = self._load_config(item)
-            config = self._transform_config(config)
+        os.chmod(tmp, cfg_path.stat().st_mode)
+        os.replace(tmp, cfg_path)
+
+    def _transform_item(self, item: pathlib.Path) -> tuple:
+        source = self._load_config(item)
+        config = self._transform_config(source)
 
-            if self._stat:
-                self._save_config(item, config)
-                print('Repo: ', item, ': updated', sep='')
+        if config == source:
+            return (item, 'ignored', '')
 
-            else:
-                print('Repo: ', item, ': ignored', sep='')
+        diff = ''.join(difflib.unified_diff(source, config, str(item), str(item)))
+        if not self._dry_run:
+            self._save_config(item, config)
+
+        return (item, 'updated', diff)
+
+    def transform(self) -> None:
+        with futures.ThreadPoolExecutor(max_workers=self._workers) as pool:
+            for (item, status, diff) in pool.map(self._transform_item, self._list):
+                if self._dry_run and diff:
+                    print(diff, end='')
+
+                else:
+                    print('Repo: ', item, ': ', status, sep='')
 
 
 def get_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
     parser.add_argument('dir_base', help='Set repositories collection directory.')
+    parser.add_argument('--depth', dest='depth', default='1', type=int, help='Set repositories search depth.')
+    parser.add_argument('--index', dest='index', default='', help='Set repositories discovery index file.')
+    parser.add_argument('--direction', dest='direction', choices=['ssh', 'https', 'keep'], default='ssh', help='Set URL scheme to rewrite into.')
+    parser.add_argument('--rule', dest='rules', action='append', default=[], help='Set regex rule as PATTERN=>REPLACEMENT.')
+    parser.add_argument('--host-map', dest='hosts', action='append', default=[], help='Set host mapping as OLD=NEW.')
+    parser.add_argument('--remote', dest='remotes', action='append', default=[], help='Set remote name to rewrite (default: all urls).')
+    parser.add_argument('--workers', dest='workers', default='8', type=int, help='Set concurrent repositories.')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true', help='Print unified diffs without writing.')
     return parser.parse_args()
 
 
@@ -91,10 +147,16 @@ if __name__ == '__main__':
     try:
         args = get_args()
 
-        dirs = GitCollection(args.dir_base)
+        dirs = git_collection.GitCollection(args.dir_base, args.depth, args.index)
         dirs.update()
 
-        repos = GitTransform(dirs)
+        rules = UrlRules(
+            [item.split('=>', 1) for item in args.rules],
+            dict(item.split('=', 1) for item in args.hosts),
+            args.direction
+        )
+
+        repos = GitTransform(dirs, rules, args.remotes, args.dry_run, args.workers)
         repos.transform()
 
     except Exception:
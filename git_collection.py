@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+import os
+import json
+import typing
+import pathlib
+
+from concurrent import futures
+
+PRUNE_DIRS = {'.git', 'node_modules', '.venv', '__pycache__'}
+
+
+class GitCollection:
+    def __init__(self, base_dir: str, depth: int = 2, index_file: str = '', workers: int = 0) -> None:
+        self._base = str(pathlib.Path(base_dir))
+        self._depth = depth
+        self._index_file = index_file
+        self._workers = workers
+
+        self._index = dict()
+        self._visited = dict()
+        self._list = list()
+
+    def __iter__(self) -> typing.Iterator:
+        return iter(self._list)
+
+    def __len__(self) -> int:
+        return len(self._list)
+
+    def _load_index(self) -> None:
+        if self._index_file and os.path.exists(self._index_file):
+            with open(self._index_file) as fd:
+                self._index = json.load(fd)
+
+    def _save_index(self) -> None:
+        if not self._index_file:
+            return
+
+        tmp = self._index_file + '.tmp'
+        with open(tmp, 'w') as fd:
+            json.dump(self._visited, fd)
+
+        os.replace(tmp, self._index_file)
+
+    def _read_dir(self, path: str) -> dict:
+        # Directory mtime changes whenever an entry is added or removed,
+        # so an unchanged directory can reuse its cached listing.
+        mtime = os.stat(path).st_mtime_ns
+        item = self._index.get(path)
+
+        if not item or item['mtime'] != mtime:
+            item = {'mtime': mtime, 'repo': False, 'dirs': list()}
+
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.name == '.git':
+                        # Worktrees and submodules have a '.git' file, not a repository.
+                        item['repo'] = entry.is_dir()
+
+                    elif entry.name not in PRUNE_DIRS and entry.is_dir():
+                        item['dirs'].append(entry.name)
+
+            item['dirs'].sort()
+
+        self._visited[path] = item
+        return item
+
+    def _scan(self, path: str, level: int) -> list:
+        repos = list()
+        stack = [(path, level)]
+
+        while stack:
+            (path, level) = stack.pop()
+
+            try:
+                item = self._read_dir(path)
+
+            except OSError:
+                continue
+
+            if item['repo'] and level > 0:
+                repos.append(path)
+
+            elif level < self._depth:
+                stack.extend((os.path.join(path, name), level + 1) for name in reversed(item['dirs']))
+
+        return repos
+
+    def update(self) -> None:
+        self._load_index()
+        self._visited = dict()
+        self._list = list()
+
+        root = self._read_dir(self._base)
+        tops = [os.path.join(self._base, name) for name in root['dirs']]
+
+        if self._workers > 1:
+            with futures.ThreadPoolExecutor(max_workers=self._workers) as pool:
+                for repos in pool.map(lambda path: self._scan(path, 1), tops):
+                    self._list.extend(repos)
+
+        else:
+            for path in tops:
+                self._list.extend(self._scan(path, 1))
+
+        self._save_index()
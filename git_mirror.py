@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+import os
+import re
+import sys
+import signal
+import time
+import fcntl
+import shutil
+import pathlib
+import argparse
+import threading
+import traceback
+import subprocess
+
+from urllib import parse as urllib
+
+
+class MirrorCache:
+    def __init__(self, base_dir: str, timeout: int = 600) -> None:
+        self._base = pathlib.Path(base_dir).expanduser().absolute()
+        self._timeout = timeout
+        self._base.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._locks = dict()
+        self._done = dict()
+
+    def __iter__(self):
+        # A bare repository is a leaf, ref directories like refs/heads/x.git are not mirrors.
+        mirrors = list()
+
+        for (root, dirs, files) in os.walk(str(self._base)):
+            if root.endswith(".git") and "HEAD" in files and "objects" in dirs:
+                mirrors.append(pathlib.Path(root))
+                dirs.clear()
+
+        return iter(sorted(mirrors))
+
+    def path_for(self, url: str) -> pathlib.Path:
+        tmp = urllib.urlparse(url)
+        if tmp.netloc or tmp.scheme == "file":
+            (host, path) = (tmp.hostname, tmp.path)
+
+        elif ":" in url and not url.startswith("/"):
+            # scp-like syntax: user@host:path
+            (host, _, path) = url.partition(":")
+            host = host.split("@")[-1]
+
+        else:
+            (host, path) = ("", url)
+
+        path = re.sub(r"[^\w.-]+", "/", path.strip("/"))
+        path = path if path.endswith(".git") else path + ".git"
+        return self._base.joinpath(host or "local", path)
+
+    def _git(self, args: list, cwd: str = None) -> int:
+        cmd = subprocess.Popen(
+            ['/usr/bin/git'] + args,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            cwd=cwd, shell=False,
+            start_new_session=True
+        )
+
+        try:
+            return cmd.wait(timeout=self._timeout or None)
+
+        except subprocess.TimeoutExpired:
+            # Kill the whole group, children like ssh keep running otherwise.
+            try:
+                os.killpg(cmd.pid, signal.SIGKILL)
+
+            except ProcessLookupError:
+                pass
+
+            return cmd.wait()
+
+    def update(self, url: str) -> pathlib.Path:
+        # Every mirror is updated at most once per run, even with many checkouts of it.
+        path = self.path_for(url)
+
+        with self._lock:
+            lock = self._locks.setdefault(str(path), threading.Lock())
+
+        with lock:
+            if str(path) in self._done:
+                return self._done[str(path)]
+
+            path.parent.mkdir(parents=True, exist_ok=True)
+
+            with open(str(path) + ".lock", "w") as fd:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+
+                # Auto gc would prune unreachable objects that borrowers may still need.
+                if path.exists():
+                    status = self._git(["-c", "gc.auto=0", "remote", "update", "--prune"], cwd=str(path))
+
+                else:
+                    status = self._git(["clone", "--mirror", "--quiet", "-c", "gc.auto=0", "-c", "gc.pruneExpire=never", url, str(path)])
+
+            if not status:
+                os.utime(str(path))
+
+            self._done[str(path)] = path if not status else None
+            return self._done[str(path)]
+
+    def link(self, repo_dir: str, url: str) -> bool:
+        # Lets an existing checkout borrow objects from the mirror via alternates.
+        mirror = self.update(url)
+        if not mirror:
+            return False
+
+        objects = str(mirror.joinpath("objects"))
+        alternates = pathlib.Path(repo_dir).joinpath(".git", "objects", "info", "alternates")
+        items = alternates.read_text().split("\n") if alternates.exists() else []
+
+        if objects not in items:
+            alternates.parent.mkdir(parents=True, exist_ok=True)
+            alternates.write_text("\n".join(list(filter(None, items)) + [objects]) + "\n")
+
+        self.register(mirror, repo_dir)
+        return True
+
+    def register(self, mirror: pathlib.Path, repo_dir: str) -> None:
+        # Checkouts borrowing objects are recorded, prune must not break them.
+        file = mirror.joinpath("borrowers")
+        repo_dir = os.path.realpath(repo_dir)
+
+        with self._lock:
+            items = file.read_text().split("\n") if file.exists() else []
+            if repo_dir not in items:
+                with open(str(file), "a") as fd:
+                    fd.write(repo_dir + "\n")
+
+    def borrowers(self, mirror: pathlib.Path) -> list:
+        file = mirror.joinpath("borrowers")
+        objects = os.path.realpath(str(mirror.joinpath("objects")))
+        items = list()
+
+        for repo_dir in filter(None, file.read_text().split("\n") if file.exists() else []):
+            alternates = pathlib.Path(repo_dir, ".git", "objects", "info", "alternates")
+
+            if alternates.exists() and objects in map(os.path.realpath, filter(None, alternates.read_text().split("\n"))):
+                items.append(repo_dir)
+
+        return items
+
+    def dissociate(self, mirror: pathlib.Path, repo_dir: str) -> bool:
+        # repack -a copies the borrowed objects into the checkout itself.
+        if self._git(["repack", "-a", "-d", "-q"], cwd=repo_dir):
+            return False
+
+        objects = os.path.realpath(str(mirror.joinpath("objects")))
+        alternates = pathlib.Path(repo_dir, ".git", "objects", "info", "alternates")
+        items = [line for line in alternates.read_text().split("\n") if line and os.path.realpath(line) != objects]
+
+        if items:
+            alternates.write_text("\n".join(items) + "\n")
+
+        else:
+            alternates.unlink()
+
+        return True
+
+    def repack(self) -> list:
+        failed = list()
+
+        for path in self:
+            # Unreachable objects are kept because checkouts may still borrow them.
+            status = self._git(["repack", "-a", "-d", "--keep-unreachable", "--write-bitmap-index", "--quiet"], cwd=str(path))
+            status = status or self._git(["pack-refs", "--all"], cwd=str(path))
+
+            if status:
+                failed.append(path)
+
+        return failed
+
+    def prune(self, days: int, dissociate: bool = False) -> tuple:
+        (removed, kept) = (list(), list())
+        limit = time.time() - days * 86400
+
+        for path in self:
+            if path.stat().st_mtime >= limit:
+                continue
+
+            users = self.borrowers(path)
+            if users and not (dissociate and all([self.dissociate(path, repo_dir) for repo_dir in users])):
+                kept.append(path)
+                continue
+
+            shutil.rmtree(str(path))
+            pathlib.Path(str(path) + ".lock").unlink(missing_ok=True)
+            removed.append(path)
+
+        return (removed, kept)
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cmd", choices=["ls", "update", "repack", "prune"], help="Set action.")
+    parser.add_argument("cache_dir", help="Set mirror cache directory.")
+    parser.add_argument("urls", nargs="*", help="Set remote URLs for update.")
+    parser.add_argument("--days", dest="days", default="90", type=int, help="Prune mirrors unused for N days.")
+    parser.add_argument("--dissociate", dest="dissociate", action="store_true", help="Copy objects into borrowing checkouts before prune.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    try:
+        args = get_args()
+        cache = MirrorCache(args.cache_dir)
+
+        if args.cmd == "ls":
+            for path in cache:
+                print(path)
+
+        elif args.cmd == "update":
+            for url in args.urls:
+                print("Mirror {}: {}".format(url, cache.update(url)))
+
+        elif args.cmd == "repack":
+            for path in cache.repack():
+                print("Repack failure:", path)
+
+        elif args.cmd == "prune":
+            (removed, kept) = cache.prune(args.days, args.dissociate)
+            for path in removed:
+                print("Removed:", path)
+
+            for path in kept:
+                print("Kept, still borrowed:", path)
+
+    except Exception:
+        traceback.print_exc()
+        sys.exit(1)
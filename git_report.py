@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+import re
+import json
+import time
+import datetime
+import threading
+
+UNITS = {'bytes': 1, 'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3}
+RECEIVED_RE = re.compile(r'(?:Receiving|Unpacking) objects:[^,\r\n]*, ([\d.]+) (bytes|KiB|MiB|GiB)')
+
+
+def clean_output(data: str) -> list:
+    # Progress lines are redrawn with '\r', only the last state of each is kept.
+    lines = map(lambda line: line.split('\r')[-1].strip(), data.split('\n'))
+    return list(filter(None, lines))
+
+
+def parse_received(data: str) -> int:
+    items = RECEIVED_RE.findall(data)
+    if not items:
+        return 0
+
+    (size, unit) = items[-1]
+    return int(float(size) * UNITS[unit])
+
+
+class RunReport:
+    def __init__(self, tool: str) -> None:
+        self._lock = threading.Lock()
+        self._tool = tool
+        self._started = datetime.datetime.now(datetime.timezone.utc)
+        self._clock = time.monotonic()
+        self._items = list()
+
+    def add(self, repo: str, status: any, wall: float, wait: float, received: int = 0) -> None:
+        with self._lock:
+            self._items.append({
+                'repo': repo, 'status': status, 'wall': round(wall, 3),
+                'wait': round(wait, 3), 'received': received
+            })
+
+    def slowest(self, top: int = 10) -> list:
+        items = sorted(self._items, key=lambda item: item['wall'], reverse=True)
+        return items[:top] if top > 0 else items
+
+    def to_dict(self, top: int = 10) -> dict:
+        return {
+            'tool': self._tool,
+            'started': self._started.isoformat(),
+            'wall': round(time.monotonic() - self._clock, 3),
+            'received': sum(item['received'] for item in self._items),
+            'slowest': self.slowest(top),
+            'repos': self._items
+        }
+
+    def save(self, file_name: str, top: int = 10) -> None:
+        with open(file_name, 'w') as fd:
+            json.dump(self.to_dict(top), fd, indent=2)
+
+    def print_slowest(self, top: int = 10) -> None:
+        print('\nSlowest:')
+        for item in self.slowest(top):
+            print('- {:.1f}s (wait {:.1f}s, {} bytes) {}'.format(item['wall'], item['wait'], item['received'], item['repo']))
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+import os
+import sys
+import gzip
+import sqlite3
+import hashlib
+import tempfile
+import pathlib
+import argparse
+import datetime
+import traceback
+
+# CDKTF_STORE_DIR
+
+
+def format_time(when: datetime.datetime) -> str:
+    # Stored as UTC with a fixed layout, so string order is time order.
+    return when.astimezone(datetime.timezone.utc).isoformat(timespec="microseconds")
+
+
+class SnapshotStore:
+    def __init__(self, base_dir: str) -> None:
+        self._base = pathlib.Path(base_dir)
+        self._objects = self._base.joinpath("objects")
+        self._objects.mkdir(parents=True, exist_ok=True)
+
+        self._db = sqlite3.connect(str(self._base.joinpath("index.db")))
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS snapshots (id INTEGER PRIMARY KEY, created TEXT NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "snapshot INTEGER NOT NULL, key TEXT NOT NULL, hash TEXT NOT NULL, PRIMARY KEY (snapshot, key));"
+            "CREATE INDEX IF NOT EXISTS entries_key ON entries (key, snapshot);"
+            "CREATE INDEX IF NOT EXISTS entries_hash ON entries (hash);"
+        )
+
+    def __enter__(self) -> "SnapshotStore":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def rollback(self) -> None:
+        self._db.rollback()
+
+    def close(self) -> None:
+        self._db.commit()
+        self._db.close()
+
+    def _blob_path(self, digest: str) -> pathlib.Path:
+        return self._objects.joinpath(digest[:2], digest[2:] + ".gz")
+
+    def put_blob(self, data: bytes) -> str:
+        # Safe to call from worker threads, it touches only the objects directory.
+        digest = hashlib.sha256(data).hexdigest()
+        file = self._blob_path(digest)
+
+        if not file.exists():
+            file.parent.mkdir(parents=True, exist_ok=True)
+            (fd, tmp) = tempfile.mkstemp(suffix=".tmp", dir=str(file.parent))
+
+            with os.fdopen(fd, "wb") as fd:
+                fd.write(gzip.compress(data, mtime=0))
+
+            os.replace(tmp, str(file))
+
+        return digest
+
+    def get_blob(self, digest: str) -> bytes:
+        return gzip.decompress(self._blob_path(digest).read_bytes())
+
+    def create_snapshot(self, created: datetime.datetime = None) -> int:
+        created = created or datetime.datetime.now(datetime.timezone.utc)
+        cursor = self._db.execute("INSERT INTO snapshots (created) VALUES (?)", (format_time(created),))
+        return cursor.lastrowid
+
+    def add_entry(self, snapshot: int, key: str, digest: str) -> None:
+        self._db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", (snapshot, key, digest))
+
+    def carry_entry(self, snapshot: int, key: str) -> bool:
+        digest = self.find(key)
+        if digest:
+            self.add_entry(snapshot, key, digest)
+
+        return bool(digest)
+
+    def find(self, key: str, when: datetime.datetime = None) -> str:
+        if when:
+            # State as of the latest snapshot taken before that time,
+            # a stack missing from it was deleted by then.
+            row = self._db.execute(
+                "SELECT e.hash FROM (SELECT id FROM snapshots WHERE created <= ? ORDER BY created DESC, id DESC LIMIT 1) s "
+                "JOIN entries e ON e.snapshot = s.id AND e.key = ?", (format_time(when), key)
+            ).fetchone()
+
+        else:
+            row = self._db.execute(
+                "SELECT e.hash FROM entries e JOIN snapshots s ON s.id = e.snapshot "
+                "WHERE e.key = ? ORDER BY s.created DESC, s.id DESC LIMIT 1", (key,)
+            ).fetchone()
+
+        return row[0] if row else ""
+
+    def list_snapshots(self) -> list:
+        return self._db.execute(
+            "SELECT s.id, s.created, COUNT(e.key) FROM snapshots s "
+            "LEFT JOIN entries e ON e.snapshot = s.id GROUP BY s.id ORDER BY s.created"
+        ).fetchall()
+
+    def gc(self, keep: int = 0, days: int = 0) -> tuple:
+        ids = [row[0] for row in self._db.execute("SELECT id FROM snapshots ORDER BY created DESC, id DESC")]
+        drop = set()
+
+        if keep > 0:
+            drop.update(ids[keep:])
+
+        if days > 0:
+            limit = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=days)
+            drop.update(row[0] for row in self._db.execute("SELECT id FROM snapshots WHERE created < ?", (format_time(limit),)))
+
+        # The latest snapshot is always preserved.
+        drop.difference_update(ids[:1])
+
+        for snapshot in drop:
+            self._db.execute("DELETE FROM entries WHERE snapshot = ?", (snapshot,))
+            self._db.execute("DELETE FROM snapshots WHERE id = ?", (snapshot,))
+
+        self._db.commit()
+        used = set(row[0] for row in self._db.execute("SELECT DISTINCT hash FROM entries"))
+        removed = 0
+
+        for file in self._objects.glob("*/*.gz"):
+            if file.parent.name + file.name[:-3] not in used:
+                file.unlink()
+                removed += 1
+
+        return (len(drop), removed)
+
+
+def parse_time(value: str) -> datetime.datetime:
+    when = datetime.datetime.fromisoformat(value)
+    return when if when.tzinfo else when.replace(tzinfo=datetime.timezone.utc)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cmd", choices=["ls", "restore", "gc"], help="Set action.")
+    parser.add_argument("key", nargs="?", default="", help="Set stack state key.")
+    parser.add_argument("--store", dest="store", default=os.environ.get("CDKTF_STORE_DIR", ".tfstate_store"), help="Set snapshot store directory.")
+    parser.add_argument("--time", dest="time", type=parse_time, help="Restore state as of ISO time.")
+    parser.add_argument("--out", dest="out", default="", help="Set restore destination file.")
+    parser.add_argument("--keep", dest="keep", default="0", type=int, help="Keep the last N snapshots.")
+    parser.add_argument("--days", dest="days", default="0", type=int, help="Drop snapshots older than N days.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    try:
+        args = parse_args()
+
+        with SnapshotStore(args.store) as store:
+            if args.cmd == "ls":
+                for (snapshot, created, count) in store.list_snapshots():
+                    print("{} {} {}".format(snapshot, created, count))
+
+            elif args.cmd == "restore":
+                digest = store.find(args.key, args.time)
+                if not digest:
+                    raise KeyError("State {} is not found!".format(args.key))
+
+                data = store.get_blob(digest)
+                if args.out:
+                    pathlib.Path(args.out).write_bytes(data)
+
+                else:
+                    sys.stdout.buffer.write(data)
+
+            elif args.cmd == "gc":
+                print("Removed snapshots: {}, blobs: {}".format(*store.gc(args.keep, args.days)))
+
+    except Exception:
+        traceback.print_exc()
+        sys.exit(1)
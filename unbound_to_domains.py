@@ -1,44 +1,116 @@
 #!/usr/bin/env python3
 import traceback
 import argparse
+import domain_sort
+
+ZONE_TYPES = {
+    'static', 'deny', 'refuse', 'redirect', 'inform_deny', 'inform_redirect',
+    'always_refuse', 'always_nxdomain', 'always_null', 'always_nodata', 'always_deny'
+}
 
 
 def arg_parse():
     parser = argparse.ArgumentParser()
     parser.add_argument('src_file', help='Set source file.')
     parser.add_argument('dst_file', help='Set destination file.')
+
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--diff', dest='diff', help='Write +added/-removed domains from src to this file.')
+    group.add_argument('--merge', dest='merge', help='Write domains found in src or this file.')
+    group.add_argument('--intersect', dest='intersect', help='Write domains found in src and this file.')
+    parser.add_argument('--chunk', dest='chunk', default='0', type=int, help='Set lines per sorted run for inputs larger than RAM (0 - in memory).')
     return parser.parse_args()
 
 
 def file_reader(fname):
-    with open(fname) as fd:
+    with open(fname, buffering=1024 * 1024) as fd:
         for line in fd:
-            line = line.rstrip()
-            line = line.lstrip()
+            line = line.strip()
 
-            if line:
+            if line and not line.startswith('#'):
                 yield line
 
 
 def file_writer(fname, itr_data):
-    with open(fname, 'w') as fd:
+    with open(fname, 'w', buffering=1024 * 1024) as fd:
         for line in itr_data:
             fd.write(line + '\n')
 
 
-def data_parse(itr_data):
+def parse_name(value):
+    return value.strip('"\'').lower().rstrip('.')
+
+
+def parse_line(line):
+    (key, sep, value) = line.partition(':')
+
+    if key == 'local-data':
+        value = value.strip().lstrip('"\'').split()
+        return parse_name(value[0]) if value else None
+
+    if key == 'local-zone':
+        value = value.split()
+        return parse_name(value[0]) if len(value) > 1 and value[1] in ZONE_TYPES else None
+
+    # Plain domain lists have neither directives nor spaces.
+    if not sep and len(line.split()) == 1:
+        return parse_name(line)
+
+    return None
+
+
+def data_parse(itr_data, unique=True):
+    seen = set()
+
     for line in itr_data:
-        if line.startswith('local-data'):
-            line = line.split()
-            line = line[1]
-            yield line.lstrip('"')
+        line = parse_line(line)
+
+        if not line or line in seen:
+            continue
+
+        if unique:
+            seen.add(line)
+
+        yield line
+
+
+def data_operation(itr_joined, operation):
+    for (line, in_src, in_other) in itr_joined:
+        if operation == 'merge':
+            yield line
+
+        elif operation == 'intersect':
+            if in_src and in_other:
+                yield line
+
+        elif in_src != in_other:
+            yield ('+' if in_other else '-') + line
 
 
 if __name__ == "__main__":
     try:
         args = arg_parse()
+        operation = next(filter(lambda name: getattr(args, name), ('diff', 'merge', 'intersect')), '')
+        external = bool(operation) and args.chunk > 0
+
+        # Sorted runs are deduplicated on merge, a seen set would defeat the memory bound.
         freader = file_reader(args.src_file)
-        dparser = data_parse(freader)
+        dparser = data_parse(freader, not external)
+
+        if operation:
+            oparser = data_parse(file_reader(getattr(args, operation)), not external)
+
+            if external:
+                joined = domain_sort.merge_join(
+                    domain_sort.external_sort(dparser, args.chunk),
+                    domain_sort.external_sort(oparser, args.chunk)
+                )
+
+            else:
+                joined = domain_sort.memory_join(dparser, oparser)
+
+            dparser = data_operation(joined, operation)
+
         file_writer(args.dst_file, dparser)
 
     except Exception: